@@ -9,9 +9,22 @@ from celery.exceptions import Retry
 from celery.utils import gen_task_name
 
 from . import trackers
-from .settings import get_task_tracker_fmts, get_task_tracker_config
+from .settings import get_tracker_settings
 from .trackers import TaskTracker
-from .utils import generate_uuid, deepcopy
+from .utils import generate_id, deepcopy
+
+
+def _is_sampled(headers, trace_id, task_name):
+    """
+    由调用方传递的_trace_sampled决定是否采样, 没有传递时按trace_id和task名采样
+    :param headers:
+    :param trace_id:
+    :param task_name:
+    :return:
+    """
+    if headers and '_trace_sampled' in headers:
+        return bool(headers['_trace_sampled'])
+    return trackers.is_sampled(trace_id, task_name)
 
 
 class Celery(_OriginalCelery):
@@ -31,8 +44,8 @@ def task_tracker():
         def __dec(*args, **kwargs):
             s_time = time.time()
             # 实例化task tracker
-            tracker_config = get_task_tracker_config()
-            tracker: TaskTracker = trackers.instance_from_settings(tracker_config['tracker'])
+            tracker_settings = get_tracker_settings()
+            tracker: TaskTracker = trackers.instance_from_settings(tracker_settings.task_tracker['tracker'])
             assert isinstance(tracker, TaskTracker)
             task = None
             trace_id = None
@@ -40,13 +53,14 @@ def task_tracker():
             if args and isinstance(args[0], Task):
                 task = args[0]
                 headers = task.request.headers
-                execution_id = task.request.id or generate_uuid(s_time, uppercase=False, length=32)
+                execution_id = task.request.id or generate_id()
                 if headers:
                     trace_id = headers.get('_trace_id', execution_id)
             else:
-                execution_id = generate_uuid(s_time, uppercase=False, length=32)
+                execution_id = generate_id()
             trace_id = trace_id or execution_id
             tracker.set_trace_id(trace_id)
+            tracker.set_sampled(_is_sampled(headers, trace_id, task.name if task else func.__name__))
             try:
                 tracker.set_task_info({
                     'id': execution_id,
@@ -54,12 +68,13 @@ def task_tracker():
                     'module': func.__module__,
                     'filename': os.path.normcase(func.__code__.co_filename),
                 })
-                if headers is not None:
-                    fmts = get_task_tracker_fmts('execution.header', tracker_config)
+                # 未采样时跳过采集
+                if headers is not None and tracker.sampled:
+                    fmts = tracker_settings.task_fmts['execution.header']
                     if fmts:
                         tracker.set_task_headers(deepcopy(headers), formats=fmts)
-                fmts = get_task_tracker_fmts('execution.params', tracker_config)
-                if fmts:
+                fmts = tracker_settings.task_fmts['execution.params']
+                if fmts and tracker.sampled:
                     try:
                         tracker.set_task_params(deepcopy({
                             'args': args[1:] if task else args,
@@ -83,8 +98,8 @@ def task_tracker():
                     tracker.set_error(e)
                 raise
             else:
-                if res is not None:
-                    fmts = get_task_tracker_fmts('execution.data', tracker_config)
+                if res is not None and tracker.sampled:
+                    fmts = tracker_settings.task_fmts['execution.data']
                     if fmts:
                         tracker.set_task_data(deepcopy(res), formats=fmts)
             finally:
@@ -159,15 +174,17 @@ class TaskHandler(object):
         self.request = self.task.request
 
         # 实例化task tracker
-        self.execution_id = self.request.id or generate_uuid(self.timer, uppercase=False, length=32)
+        self.execution_id = self.request.id or generate_id()
         if self.request.headers:
             self.trace_id = self.request.headers.get('_trace_id', self.execution_id)
         else:
             self.trace_id = self.execution_id
-        self.tracker_config = get_task_tracker_config()
+        self.tracker_settings = get_tracker_settings()
+        self.tracker_config = self.tracker_settings.task_tracker
         self.tracker: TaskTracker = trackers.instance_from_settings(self.tracker_config['tracker'],
                                                                     trace_id=self.trace_id)
         assert isinstance(self.tracker, TaskTracker)
+        self.tracker.set_sampled(_is_sampled(self.request.headers, self.trace_id, self.task.name))
 
     def run(self, *args, **kwargs):
         try:
@@ -178,12 +195,13 @@ class TaskHandler(object):
                 'module': task_module,
                 'filename': inspect.getfile(self.__class__)
             })
-            if self.request.headers is not None:
-                fmts = get_task_tracker_fmts('execution.header', self.tracker_config)
+            # 未采样时跳过采集
+            if self.request.headers is not None and self.tracker.sampled:
+                fmts = self.tracker_settings.task_fmts['execution.header']
                 if fmts:
                     self.tracker.set_task_headers(deepcopy(self.request.headers), formats=fmts)
-            fmts = get_task_tracker_fmts('execution.params', self.tracker_config)
-            if fmts:
+            fmts = self.tracker_settings.task_fmts['execution.params']
+            if fmts and self.tracker.sampled:
                 try:
                     self.tracker.set_task_params(deepcopy({'args': args, 'kwargs': kwargs}), formats=fmts)
                 except TypeError as e:
@@ -200,8 +218,8 @@ class TaskHandler(object):
                 self.tracker.set_error(e)
             raise
         else:
-            if res is not None:
-                fmts = get_task_tracker_fmts('execution.data', self.tracker_config)
+            if res is not None and self.tracker.sampled:
+                fmts = self.tracker_settings.task_fmts['execution.data']
                 if fmts:
                     self.tracker.set_task_data(deepcopy(res), formats=fmts)
         finally:
@@ -221,17 +239,17 @@ class TaskHandler(object):
         if isinstance(task, str):
             task = self.task.app.tasks[task]
         if 'headers' in kwargs:
-            kwargs['headers']['headers']['_trace_id'] = self.tracker.trace_id
+            kwargs['headers']['headers'].update(self.tracker.get_trace_headers())
         else:
-            kwargs['headers'] = {'headers': {'_trace_id': self.tracker.trace_id}}
+            kwargs['headers'] = {'headers': self.tracker.get_trace_headers()}
         return task.apply_async(*args, **kwargs)
 
     def si(self, task, *args, **kwargs):
         headers = kwargs.pop('headers', {})
-        headers['_trace_id'] = self.tracker.trace_id
+        headers.update(self.tracker.get_trace_headers())
         return task.si(*args, **kwargs).set(headers={'headers': headers})
 
     def s(self, task, *args, **kwargs):
         headers = kwargs.pop('headers', {})
-        headers['_trace_id'] = self.tracker.trace_id
+        headers.update(self.tracker.get_trace_headers())
         return task.s(*args, **kwargs).set(headers={'headers': headers})
@@ -0,0 +1,97 @@
+"""
+json编解码的统一入口, 安装了orjson时使用orjson, 否则使用标准库json
+datetime/date/time/Promise/set等类型仍由JSONEncoder.default处理, 与标准库的结果一致;
+配置了自定义JSON_ENCODER时只使用标准库
+与标准库的差异: orjson将NaN/Infinity编码为null
+"""
+import importlib
+import json
+
+from .common import DefaultJSONEncoder
+from .settings import get_json_backend, get_json_encoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _load_encoder():
+    cname = get_json_encoder()
+    if cname == 'django_chilies.utils.JSONEncoder':
+        return DefaultJSONEncoder
+    module_name, name = cname.rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), name)
+
+
+JSONEncoder = _load_encoder()
+
+_backend = get_json_backend()
+assert _backend in ('auto', 'orjson', 'json'), 'invalid JSON_BACKEND: %s' % _backend
+assert _backend != 'orjson' or orjson is not None, 'JSON_BACKEND is orjson but orjson is not installed'
+
+if orjson is not None and _backend != 'json' and JSONEncoder is DefaultJSONEncoder:
+    BACKEND = 'orjson'
+    # datetime交给default按DATETIME_FORMAT等格式化; dict的非str键与标准库一样转为str
+    _OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+    _default = JSONEncoder().default
+else:
+    BACKEND = 'json'
+
+
+def dumpb(o, indent=None, compact=True):
+    """
+    编码为utf-8 bytes, 非ascii字符不转义
+    :param o:
+    :param indent: None或缩进空格数, orjson只支持2
+    :param compact: 无缩进时是否去掉分隔符后的空格
+    :return:
+    """
+    if BACKEND == 'orjson' and (indent == 2 or (indent is None and compact)):
+        try:
+            return orjson.dumps(o, default=_default, option=(_OPTIONS | orjson.OPT_INDENT_2) if indent else _OPTIONS)
+        except TypeError:
+            # 超过64位的整数等orjson不支持的值
+            pass
+    return _dumps(o, indent, compact).encode('utf-8')
+
+
+def dumps(o, indent=None, compact=True):
+    """
+    编码为str, 参数同dumpb
+    """
+    if BACKEND == 'orjson' and (indent == 2 or (indent is None and compact)):
+        return dumpb(o, indent, compact).decode('utf-8')
+    return _dumps(o, indent, compact)
+
+
+# 数字映射为b'0', 其余字节映射为b' ', 连续19位数字可能超出64位整数, orjson会将其解码为float
+# 用translate查找比正则快一个数量级
+_DIGITS = bytes(48 if 48 <= i <= 57 else 32 for i in range(256))
+_WIDE_INT = b'0' * 19
+
+
+def _has_wide_int(s):
+    if isinstance(s, str):
+        s = s.encode('utf-8')
+    return _WIDE_INT in s.translate(_DIGITS)
+
+
+def loads(s):
+    """
+    超出64位的整数由标准库解码, 保持为int
+    :param s: str或bytes
+    :return:
+    """
+    if orjson is not None and not _has_wide_int(s):
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError:
+            # NaN/Infinity等标准库接受的输入
+            pass
+    return json.loads(s)
+
+
+def _dumps(o, indent, compact):
+    separators = (',', ':') if compact and indent is None else None
+    return json.dumps(o, ensure_ascii=False, indent=indent, separators=separators, cls=JSONEncoder)
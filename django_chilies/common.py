@@ -1,5 +1,8 @@
+import base64
 import datetime
+import decimal
 import json
+import uuid
 from collections.abc import KeysView, ValuesView
 from json import JSONEncoder
 from kombu.utils.json import JSONEncoder as KombuJSONEncoder
@@ -11,20 +14,133 @@ from kombu.serialization import register
 from .settings import DATETIME_FORMAT, DATE_FORMAT, TIME_FORMAT
 
 
+class LazyValue(object):
+    """
+    延迟计算的值, 在编码或str时才计算, 计算结果会被缓存
+    """
+    __slots__ = ('_func', '_args', '_value')
+    _UNSET = object()
+
+    def __init__(self, func, *args):
+        self._func = func
+        self._args = args
+        self._value = self._UNSET
+
+    def resolve(self):
+        if self._value is self._UNSET:
+            self._value = self._func(*self._args)
+            self._func = self._args = None
+        return self._value
+
+    def __str__(self):
+        return str(self.resolve())
+
+    def __repr__(self):
+        return '<LazyValue: %s>' % ('resolved' if self._value is not self._UNSET else 'unresolved')
+
+
+def resolve_lazy(o, depth=2):
+    """
+    将dict中前depth层的LazyValue替换为计算结果, 只复制包含LazyValue的dict
+    """
+    if isinstance(o, LazyValue):
+        return o.resolve()
+    if depth <= 0 or not isinstance(o, dict):
+        return o
+    resolved = None
+    for k, v in o.items():
+        if isinstance(v, (LazyValue, dict)):
+            r = resolve_lazy(v, depth - 1)
+            if r is not v:
+                if resolved is None:
+                    resolved = dict(o)
+                resolved[k] = r
+    return o if resolved is None else resolved
+
+
+# 注册的类型 -> 编码函数, 按注册顺序
+_type_handlers = {}
+# 具体的类 -> 编码函数, 没有对应的编码函数时为None
+_handler_cache = {}
+
+
+def register_type(cls, fn):
+    """
+    注册cls及其子类的json编码函数, 由DefaultJSONEncoder和codec使用
+    :param cls:
+    :param fn: fn(obj), 返回可被json编码的值
+    :return:
+    """
+    _type_handlers[cls] = fn
+    _handler_cache.clear()
+
+
+def get_type_handler(cls):
+    """
+    cls的编码函数, 优先取mro中最近的注册类型, 其次按注册顺序判断issubclass(如KeysView等抽象类)
+    结果按cls缓存
+    :param cls:
+    :return: 编码函数或None
+    """
+    try:
+        return _handler_cache[cls]
+    except KeyError:
+        pass
+    handler = None
+    for base in cls.__mro__:
+        if base in _type_handlers:
+            handler = _type_handlers[base]
+            break
+    else:
+        for t, fn in _type_handlers.items():
+            if issubclass(cls, t):
+                handler = fn
+                break
+    _handler_cache[cls] = handler
+    return handler
+
+
+def _strftime(fmt, iso_fmt, iso):
+    """
+    格式为默认值时用isoformat代替strftime, 结果相同但更快; 带时区或年份不足4位时isoformat的结果不同
+    """
+    if fmt != iso_fmt:
+        return lambda o: o.strftime(fmt)
+    return lambda o: iso(o) if getattr(o, 'tzinfo', None) is None and getattr(o, 'year', 1000) >= 1000 \
+        else o.strftime(fmt)
+
+
+def _encode_bytes(o):
+    # 与kombu的编码结果相同
+    try:
+        return {'__type__': 'bytes', '__value__': o.decode('utf-8')}
+    except UnicodeDecodeError:
+        return {'__type__': 'base64', '__value__': base64.b64encode(o).decode('utf-8')}
+
+
+register_type(LazyValue, LazyValue.resolve)
+register_type(datetime.datetime, _strftime(DATETIME_FORMAT, '%Y-%m-%d %H:%M:%S',
+                                           lambda o: o.isoformat(' ', 'seconds')))
+register_type(datetime.date, _strftime(DATE_FORMAT, '%Y-%m-%d', datetime.date.isoformat))
+register_type(datetime.time, _strftime(TIME_FORMAT, '%H:%M:%S', lambda o: o.isoformat('seconds')))
+register_type(Promise, force_str)
+register_type(set, list)
+register_type(KeysView, list)
+register_type(ValuesView, list)
+# orjson直接将UUID编码为字符串且无法交给default处理, 两种backend都编码为字符串(与drf一致)
+register_type(uuid.UUID, str)
+# 以下与kombu的编码结果相同
+register_type(decimal.Decimal, lambda o: {'__type__': 'decimal', '__value__': str(o)})
+register_type(bytes, _encode_bytes)
+register_type(memoryview, lambda o: _encode_bytes(o.tobytes()))
+
+
 class DefaultJSONEncoder(KombuJSONEncoder, JSONEncoder):
 
     def default(self, obj, *args, **kwargs):
-        if isinstance(obj, datetime.datetime):
-            return obj.strftime(DATETIME_FORMAT)
-        if isinstance(obj, datetime.date):
-            return obj.strftime(DATE_FORMAT)
-        if isinstance(obj, datetime.time):
-            return obj.strftime(TIME_FORMAT)
-        if isinstance(obj, Promise):
-            return force_str(obj)
-        if isinstance(obj, (set, KeysView, ValuesView)):
-            return list(obj)
-
+        handler = _handler_cache.get(obj.__class__) or get_type_handler(obj.__class__)
+        if handler is not None:
+            return handler(obj)
         return super().default(obj, *args, **kwargs)
 
 
@@ -8,7 +8,6 @@ from rest_framework.views import APIView
 from . import errors
 from .errors import APICodes
 from .serializers import PaginationListSerializer
-from .settings import get_http_tracker_fmts
 from .trackers import HTTPTracker
 from .utils import deepcopy
 
@@ -319,20 +318,22 @@ class TrackerMixin(ControllerMixin):
         self.tracker: HTTPTracker = self.request.tracker
 
     def before_process(self, *args, **kwargs):
-        if hasattr(self, 'unvalidated_params'):
-            fmts = get_http_tracker_fmts('request.params', self.request.tracker_config)
-            if fmts:
-                self.tracker.set_request_params(
-                    self.filter_tracked_params(self.unvalidated_params),
-                    formats=fmts
-                )
-        # request user
-        user = {
-            'username': getattr(self.request.user, 'username', None),
-            'is_anonymous': getattr(self.request.user, 'is_anonymous', False)
-        }
-        self.tracker.set_user(self.filter_tracked_user(user))
-        self.tracker.set_operator(self.filter_tracked_operator({}))
+        # 未采样时跳过采集
+        if self.tracker.sampled:
+            if hasattr(self, 'unvalidated_params'):
+                fmts = self.request.tracker_settings.http_fmts['request.params']
+                if fmts:
+                    self.tracker.set_request_params(
+                        self.filter_tracked_params(self.unvalidated_params),
+                        formats=fmts
+                    )
+            # request user
+            user = {
+                'username': getattr(self.request.user, 'username', None),
+                'is_anonymous': getattr(self.request.user, 'is_anonymous', False)
+            }
+            self.tracker.set_user(self.filter_tracked_user(user))
+            self.tracker.set_operator(self.filter_tracked_operator({}))
 
         super().before_process(*args, **kwargs)
 
@@ -349,9 +350,9 @@ class TrackerMixin(ControllerMixin):
         else:
             self.tracker.set_error(error)
 
-        if not self.tracker.request_params_tracked:
+        if self.tracker.sampled and not self.tracker.request_params_tracked:
             if hasattr(self, 'unvalidated_params'):
-                fmts = get_http_tracker_fmts('request.params', self.request.tracker_config)
+                fmts = self.request.tracker_settings.http_fmts['request.params']
                 if fmts:
                     self.tracker.set_request_params(
                         self.filter_tracked_params(self.unvalidated_params),
@@ -367,16 +368,22 @@ class TrackerMixin(ControllerMixin):
         return super().on_error(error, *args, **kwargs)
 
     def before_response(self, *args, **kwargs):
-        if hasattr(self, 'data'):
-            fmts = get_http_tracker_fmts('response.data', self.request.tracker_config)
+        if self.tracker.sampled and hasattr(self, 'data'):
+            # api code用于日志级别和tail retention的判断, 与是否记录response.data无关
+            self.tracker.set_api_result(self.data)
+            fmts = self.request.tracker_settings.http_fmts['response.data']
             if fmts:
-                self.tracker.set_response_data(
-                    self.filter_tracked_data(deepcopy(self.data)),
-                    formats=fmts
-                )
+                # data的复制可能被延迟或跳过
+                self.tracker.capture(self._track_response_data, fmts)
 
         super().before_response(*args, **kwargs)
 
+    def _track_response_data(self, fmts):
+        self.tracker.set_response_data(
+            self.filter_tracked_data(deepcopy(self.data)),
+            formats=fmts
+        )
+
     def apply_async(self, task_func, *args, **kwargs):
         return self.request.apply_async(task_func, *args, **kwargs)
 
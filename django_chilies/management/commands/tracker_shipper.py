@@ -0,0 +1,84 @@
+import fcntl
+import os
+import signal
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from django_chilies import codec, writers
+
+
+class Command(BaseCommand):
+    help = 'forward tracker messages from the shared ring buffer of a RingWriter to its writers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('writer', help='name of the RingWriter in DJANGO_CHILIES.TRACKER.writers')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--poll-interval', type=float, default=0.05,
+                            help='seconds to sleep when the buffer is empty')
+        parser.add_argument('--flush-interval', type=float, default=1.0,
+                            help='seconds between flushes of the target writers')
+
+    def handle(self, *args, **options):
+        name = options['writer']
+        try:
+            ring_writer = writers.instance_from_settings(name)
+        except AssertionError as e:
+            raise CommandError(str(e))
+        if not isinstance(ring_writer, writers.RingWriter):
+            raise CommandError('writer is not a RingWriter: %s' % name)
+        targets = [writers.instance_from_settings(n) for n in ring_writer.writers]
+        if not targets:
+            raise CommandError('no writers to forward to, set "writers" of %s' % name)
+
+        # 每个环形缓冲只能有一个读取进程
+        lock_fd = os.open(ring_writer.path + '.shipper', os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise CommandError('another shipper is running for %s' % ring_writer.path)
+
+        stopping = []
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, lambda *_: stopping.append(True))
+
+        ring = ring_writer.ring
+        self.stdout.write('shipping %s -> %s' % (ring_writer.path, ', '.join(ring_writer.writers)))
+        shipped = 0
+        dropped = ring.dropped
+        flushed_at = time.monotonic()
+        while True:
+            records = ring.get(options['batch_size'])
+            for data in records:
+                self.ship(data, targets)
+            shipped += len(records)
+
+            if time.monotonic() - flushed_at >= options['flush_interval'] or (stopping and not records):
+                for target in targets:
+                    target.flush()
+                flushed_at = time.monotonic()
+                if ring.dropped != dropped:
+                    dropped = ring.dropped
+                    self.stderr.write('%s messages dropped by writers, buffer full' % dropped)
+
+            if not records:
+                if stopping:
+                    break
+                time.sleep(options['poll_interval'])
+
+        for target in targets:
+            target.close()
+        ring.close()
+        self.stdout.write('shipped %s messages' % shipped)
+
+    def ship(self, data, targets):
+        try:
+            payload = writers.Payload(codec.loads(data), encoded=data)
+        except ValueError as e:
+            self.stderr.write('invalid message skipped: %s' % e)
+            return
+        for target in targets:
+            try:
+                target.write_payload(payload)
+            except Exception as e:
+                writers.default_logger.exception(e)
@@ -0,0 +1,167 @@
+"""
+tracker和writer的进程内指标, 计数只做dict/list的自增, 可在生产环境常开
+多进程部署时每个进程单独统计, 由采集端按进程汇总
+"""
+import bisect
+from collections import Counter
+
+from django.http import HttpResponse
+
+from . import writers
+from .utils import register_after_fork
+
+# 秒
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+class Histogram(object):
+    """
+    固定分桶的直方图, buckets为各桶的上界(含), 超过最大上界的值计入+Inf
+    """
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """
+        :return: [(上界, 小于等于上界的次数)], 最后一项的上界为float('inf')
+        """
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class Metrics(object):
+    """
+    一个tracker或writer的计数和耗时
+    """
+    __slots__ = ('counters', 'histograms')
+
+    def __init__(self):
+        self.counters = Counter()
+        self.histograms = {}
+
+    def histogram(self, name):
+        h = self.histograms.get(name)
+        if h is None:
+            h = self.histograms[name] = Histogram()
+        return h
+
+
+_trackers = {}
+_writers = {}
+
+
+def tracker_metrics(name):
+    m = _trackers.get(name)
+    if m is None:
+        m = _trackers[name] = Metrics()
+    return m
+
+
+def writer_metrics(name):
+    m = _writers.get(name)
+    if m is None:
+        m = _writers[name] = Metrics()
+    return m
+
+
+@register_after_fork
+def reset():
+    _trackers.clear()
+    _writers.clear()
+
+
+def writer_counters():
+    """
+    当前进程中已创建的writer自身的计数, 包装的writer(async/spool/circuit_breaker)逐层展开
+    :return: {writer名称: {层的类名: Counter}}
+    """
+    result = {}
+    for name, writer in writers.registry.items():
+        layers = result[name] = {}
+        while writer is not None:
+            counters = getattr(writer, 'counters', None)
+            if counters is not None:
+                layers[writer.__class__.__name__] = Counter(counters)
+            writer = getattr(writer, 'writer', None)
+    return result
+
+
+def collect():
+    """
+    当前进程的指标快照
+    :return:
+    """
+    return {
+        'trackers': {name: {'counters': Counter(m.counters), 'histograms': dict(m.histograms)}
+                     for name, m in list(_trackers.items())},
+        'writers': {name: {'counters': Counter(m.counters), 'histograms': dict(m.histograms)}
+                    for name, m in list(_writers.items())},
+        'writer_counters': writer_counters(),
+    }
+
+
+def _labels(**labels):
+    return ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels.items())
+
+
+def _render_histogram(lines, metric, h, **labels):
+    for bound, count in h.cumulative():
+        le = '+Inf' if bound == float('inf') else repr(bound)
+        lines.append('%s_bucket{%s,le="%s"} %s' % (metric, _labels(**labels), le, count))
+    lines.append('%s_sum{%s} %s' % (metric, _labels(**labels), repr(h.sum)))
+    lines.append('%s_count{%s} %s' % (metric, _labels(**labels), h.count))
+
+
+def render_text():
+    """
+    prometheus文本格式
+    :return:
+    """
+    data = collect()
+    lines = [
+        '# TYPE django_chilies_tracker_events_total counter',
+    ]
+    for name, m in sorted(data['trackers'].items()):
+        for event, value in sorted(m['counters'].items()):
+            lines.append('django_chilies_tracker_events_total{%s} %s' % (_labels(tracker=name, event=event), value))
+    lines.append('# TYPE django_chilies_tracker_seconds histogram')
+    for name, m in sorted(data['trackers'].items()):
+        for op, h in sorted(m['histograms'].items()):
+            _render_histogram(lines, 'django_chilies_tracker_seconds', h, tracker=name, op=op)
+
+    lines.append('# TYPE django_chilies_writer_events_total counter')
+    for name, m in sorted(data['writers'].items()):
+        for event, value in sorted(m['counters'].items()):
+            lines.append('django_chilies_writer_events_total{%s} %s' % (
+                _labels(writer=name, layer='Tracker', event=event), value))
+    for name, layers in sorted(data['writer_counters'].items()):
+        for layer, counters in sorted(layers.items()):
+            for event, value in sorted(counters.items()):
+                lines.append('django_chilies_writer_events_total{%s} %s' % (
+                    _labels(writer=name, layer=layer, event=event), value))
+    lines.append('# TYPE django_chilies_writer_seconds histogram')
+    for name, m in sorted(data['writers'].items()):
+        for op, h in sorted(m['histograms'].items()):
+            _render_histogram(lines, 'django_chilies_writer_seconds', h, writer=name, op=op)
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_view(request):
+    """
+    挂载到urlconf: path('metrics', metrics_view)
+    """
+    return HttpResponse(render_text(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -8,16 +8,16 @@ from django.urls import resolve
 from django.utils.deprecation import MiddlewareMixin
 
 from . import trackers
-from .settings import get_http_tracker_config, get_http_tracker_fmts
+from .settings import get_tracker_settings
 from .trackers import HTTPTracker
-from .utils import generate_uuid, request_headers_dict, response_headers_dict
+from .utils import generate_id, request_headers_dict, response_headers_dict
 
 
 def _request_task_apply_async(request, task, *args, **kwargs):
     if 'headers' in kwargs:
-        kwargs['headers']['headers']['_trace_id'] = request.tracker.trace_id
+        kwargs['headers']['headers'].update(request.tracker.get_trace_headers())
     else:
-        kwargs['headers'] = {'headers': {'_trace_id': request.tracker.trace_id}}
+        kwargs['headers'] = {'headers': request.tracker.get_trace_headers()}
     return task.apply_async(*args, **kwargs)
 
 
@@ -33,45 +33,77 @@ class TrackerMiddleware(MiddlewareMixin):
         request.timer = time()
         request.id = self.get_request_id(request)
         trace_id = self.get_trace_id(request)
+        http_info = self.__get_http_info(request)
 
         # 实例化http tracker
-        tracker_config = get_http_tracker_config()
-        request.tracker: HTTPTracker = trackers.instance_from_settings(tracker_config['tracker'], trace_id=trace_id)
+        tracker_settings = get_tracker_settings()
+        request.tracker: HTTPTracker = trackers.instance_from_settings(tracker_settings.http_tracker['tracker'],
+                                                                       trace_id=trace_id)
         assert isinstance(request.tracker, HTTPTracker)
-        request.tracker_config = tracker_config
+        request.tracker_settings = tracker_settings
+        request.tracker_config = tracker_settings.http_tracker
         request.tracker.set_request_id(request.id)
+        request.tracker.set_sampled(self.is_sampled(request, trace_id, http_info))
+
+        # celery tasks with request
+        request.delay = functools.partial(_request_task_delay, request)
+        request.apply_async = functools.partial(_request_task_apply_async, request)
+
+        # 未采样时跳过采集
+        if not request.tracker.sampled:
+            return
+
+        # tail retention: 请求期间只记录引用, 在process_response中决定是否采集
+        if tracker_settings.retention['enabled']:
+            request.tracker.defer_captures()
 
         # http info
-        http_info = self.__get_http_info(request)
         request.tracker.set_http_info(self.filter_tracked_http_info(request, http_info))
         # request headers
-        fmts = get_http_tracker_fmts('request.header', tracker_config)
+        fmts = tracker_settings.http_fmts['request.header']
         if fmts:
-            request.tracker.set_request_headers(
-                self.filter_tracked_request_headers(request, request_headers_dict(request)),
-                formats=fmts
-            )
+            request.tracker.capture(self.__track_request_headers, request, fmts)
         # request body
-        if get_http_tracker_fmts('request.body', tracker_config):
+        if tracker_settings.http_fmts['request.body']:
             try:
-                request.tracker.set_request_body(self.filter_tracked_request_body(request, request.body.decode()))
+                # body需要在view读取stream之前获取
+                request.tracker.capture(self.__track_request_body, request, request.body)
             except Exception as e:
                 logging.getLogger('django.server').exception(e)
 
-        # celery tasks with request
-        request.delay = functools.partial(_request_task_delay, request)
-        request.apply_async = functools.partial(_request_task_apply_async, request)
+    def __track_request_headers(self, request, fmts):
+        request.tracker.set_request_headers(
+            self.filter_tracked_request_headers(request, request_headers_dict(request)),
+            formats=fmts
+        )
+
+    def __track_request_body(self, request, body):
+        request.tracker.set_request_body(self.filter_tracked_request_body(request, body.decode()))
 
     def process_response(self, request, response):
+        if not request.tracker.sampled:
+            # 只计数, 不构造消息
+            request.tracker.persistent()
+            return response
+        http_result = self.__get_http_result(request, response)
+        request.tracker.set_retained(self.is_retained(request, response, http_result))
+        if request.tracker.retained:
+            self.__track_response(request, response)
+        # http result
+        request.tracker.set_http_result(self.filter_tracked_http_result(request, response, http_result))
+        request.tracker.persistent()
+        return response
+
+    def __track_response(self, request, response):
         # response headers
-        fmts = get_http_tracker_fmts('response.header', request.tracker_config)
+        fmts = request.tracker_settings.http_fmts['response.header']
         if fmts:
             request.tracker.set_response_headers(
                 self.filter_tracked_response_headers(request, response, response_headers_dict(response)),
                 formats=fmts
             )
         # response body
-        if get_http_tracker_fmts('response.body', request.tracker_config):
+        if request.tracker_settings.http_fmts['response.body']:
             try:
                 if not getattr(response, 'streaming', False):
                     request.tracker.set_response_body(
@@ -79,11 +111,6 @@ class TrackerMiddleware(MiddlewareMixin):
                     )
             except Exception as e:
                 logging.getLogger('django.server').exception(e)
-        # http result
-        http_result = self.__get_http_result(request, response)
-        request.tracker.set_http_result(self.filter_tracked_http_result(request, response, http_result))
-        request.tracker.persistent()
-        return response
 
     def process_exception(self, request, exception):
         request.tracker.set_error(exception)
@@ -131,7 +158,7 @@ class TrackerMiddleware(MiddlewareMixin):
         :param request:
         :return:
         """
-        return generate_uuid(request.timer, uppercase=False, length=32)
+        return generate_id()
 
     def get_trace_id(self, request):
         """
@@ -141,6 +168,26 @@ class TrackerMiddleware(MiddlewareMixin):
         """
         return request.id
 
+    def is_sampled(self, request, trace_id, http_info):
+        """
+        to be override, head sampling of the request, by TRACKER.sampling and url_name
+        :param request:
+        :param trace_id:
+        :param http_info:
+        :return:
+        """
+        return trackers.is_sampled(trace_id, http_info['url_name'])
+
+    def is_retained(self, request, response, http_result):
+        """
+        to be override, tail retention of the request, full message if True, otherwise summary
+        :param request:
+        :param response:
+        :param http_result:
+        :return:
+        """
+        return request.tracker.is_retained(http_result['status_code'], http_result['duration'])
+
     def filter_tracked_http_info(self, request, o: dict) -> dict:
         """
         to be override
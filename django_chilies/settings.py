@@ -1,6 +1,7 @@
-import json
+from types import MappingProxyType
 
 from django.conf import settings
+from django.core.signals import setting_changed
 
 DEFAULT = {
     'DATETIME_FORMAT': '%Y-%m-%d %H:%M:%S',
@@ -8,11 +9,31 @@ DEFAULT = {
     'DATE_FORMAT': '%Y-%m-%d',
     'TIME_FORMAT': '%H:%M:%S',
     'JSON_ENCODER': 'django_chilies.utils.JSONEncoder',
+    'JSON_BACKEND': 'auto',  # auto (orjson if installed), orjson or json
+    'ID_GENERATOR': 'django_chilies.utils.time_ordered_id',  # callable returning request/trace/execution ids
     'BASE_DIR': '',  # base path of django project
     'TRACKER': {
-        'buffer_size': 1000,
+        'buffer_size': 1000,  # max lines per session
+        'buffer_bytes': 1024 * 1024,  # max bytes per session
+        'buffer_policy': 'keep_head',  # keep_head, keep_tail or keep_errors, when buffer overflows
+        'capture_caller': True,  # record file/func/lineno of each log line
         'level': 'INFO',
         'console': 'django',  # default console logger
+        'host_fields': {},  # static fields attached to every message, e.g. app_name, env_name, pod_name
+        'snapshot': {  # limits when copying tracked params/data, None for no limit
+            'max_depth': None,  # nesting depth of containers
+            'max_items': None,  # items kept per list/dict
+            'max_size': None,  # approximate json size in bytes
+        },
+        'sampling': {  # head sampling, decided once per trace_id and propagated to celery tasks
+            'rate': 1.0,  # fraction of traces tracked, 0 ~ 1
+            'routes': {},  # rate by url_name or task name, e.g. {'health': 0, 'api.tasks.sync': 0.1}
+        },
+        'retention': {  # tail retention of http traces, decided when the response is known
+            'enabled': False,  # full message only for errors, 4xx/5xx and slow requests, summary for the rest
+            'slow_ms': 1000,  # full message when duration > slow_ms
+            'routes': {},  # slow_ms by url_name
+        },
         'http_tracker': {
             'tracker': 'http-tracker',
             'request': ['header', 'Header', 'Body', 'params', 'Params'],
@@ -30,7 +51,8 @@ DEFAULT = {
                 'producer': {
                     'bootstrap_servers': ['127.0.0.1:9092'],
                     'security_protocol': 'PLAINTEXT',
-                    'value_serializer': lambda msg: json.dumps(msg, ensure_ascii=False).encode("utf-8"),
+                    # messages are encoded once by the tracker and sent as bytes,
+                    # set value_serializer only if kafka needs a different format
                 }
             },
             'system': {
@@ -78,6 +100,14 @@ def get_json_encoder():
     return get_config('JSON_ENCODER')
 
 
+def get_json_backend():
+    return get_config('JSON_BACKEND')
+
+
+def get_id_generator():
+    return get_config('ID_GENERATOR')
+
+
 def get_base_dir():
     return get_config('BASE_DIR')
 
@@ -106,10 +136,50 @@ def get_default_buffer_size():
         'buffer_size']
 
 
+def get_default_buffer_bytes():
+    # None或0关闭字节数限制
+    return getattr(settings, 'DJANGO_CHILIES', {}).get('TRACKER', {}).get(
+        'buffer_bytes', DEFAULT['TRACKER']['buffer_bytes'])
+
+
+def get_snapshot_config():
+    return {**DEFAULT['TRACKER']['snapshot'],
+            **(getattr(settings, 'DJANGO_CHILIES', {}).get('TRACKER', {}).get('snapshot') or {})}
+
+
+def get_sampling_config():
+    config = {**DEFAULT['TRACKER']['sampling'],
+              **(getattr(settings, 'DJANGO_CHILIES', {}).get('TRACKER', {}).get('sampling') or {})}
+    assert 0 <= config['rate'] <= 1, 'invalid sampling rate: %s' % config['rate']
+    for route, rate in config['routes'].items():
+        assert 0 <= rate <= 1, 'invalid sampling rate of %s: %s' % (route, rate)
+    return config
+
+
+def get_retention_config():
+    return {**DEFAULT['TRACKER']['retention'],
+            **(getattr(settings, 'DJANGO_CHILIES', {}).get('TRACKER', {}).get('retention') or {})}
+
+
+def get_default_buffer_policy():
+    return getattr(settings, 'DJANGO_CHILIES', {}).get('TRACKER', {}).get('buffer_policy') or DEFAULT['TRACKER'][
+        'buffer_policy']
+
+
+def get_default_capture_caller():
+    return getattr(settings, 'DJANGO_CHILIES', {}).get('TRACKER', {}).get(
+        'capture_caller', DEFAULT['TRACKER']['capture_caller'])
+
+
 def get_default_console():
     return getattr(settings, 'DJANGO_CHILIES', {}).get('TRACKER', {}).get('console') or DEFAULT['TRACKER']['console']
 
 
+def get_host_fields():
+    return getattr(settings, 'DJANGO_CHILIES', {}).get('TRACKER', {}).get('host_fields') or DEFAULT['TRACKER'][
+        'host_fields']
+
+
 def get_trackers_config():
     return dict(DEFAULT['TRACKER']['trackers'],
                 **getattr(settings, 'DJANGO_CHILIES', {}).get('TRACKER', {}).get('trackers', {}))
@@ -122,9 +192,9 @@ def get_http_tracker_fmts(_type, config=None):
     :param config:
     :return:
     """
-    k1, k2 = _type.split('.')
     if config is None:
-        config = get_http_tracker_config()
+        return get_tracker_settings().http_fmts[_type]
+    k1, k2 = _type.split('.')
     fmts = []
     if k2 == 'header':
         for item in config.get(k1, []):
@@ -160,9 +230,9 @@ def get_task_tracker_fmts(_type, config=None):
     :param config:
     :return:
     """
-    k1, k2 = _type.split('.')
     if config is None:
-        config = get_task_tracker_config()
+        return get_tracker_settings().task_fmts[_type]
+    k1, k2 = _type.split('.')
     fmts = []
     if k2 == 'header':
         for item in config.get(k1, []):
@@ -186,3 +256,69 @@ def get_task_tracker_fmts(_type, config=None):
         raise Exception()
 
     return fmts
+
+
+class TrackerSettings(object):
+    """
+    编译后的TRACKER配置, 不可变
+    各section的formats预先计算, 避免每次请求重复读取settings和比较字符串
+    """
+    __slots__ = ('level', 'buffer_size', 'buffer_bytes', 'buffer_policy', 'capture_caller', 'console',
+                 'http_tracker', 'task_tracker', 'http_fmts', 'task_fmts', 'writers', 'trackers', 'snapshot',
+                 'id_generator', 'sampling', 'retention')
+
+    def __init__(self):
+        sampling = get_sampling_config()
+        retention = get_retention_config()
+        values = {
+            'level': get_default_level(),
+            'buffer_size': get_default_buffer_size(),
+            'buffer_bytes': get_default_buffer_bytes(),
+            'buffer_policy': get_default_buffer_policy(),
+            'capture_caller': get_default_capture_caller(),
+            'console': get_default_console(),
+            'http_tracker': MappingProxyType(dict(get_http_tracker_config())),
+            'task_tracker': MappingProxyType(dict(get_task_tracker_config())),
+            'writers': MappingProxyType({k: MappingProxyType(v) for k, v in get_writers_config().items()}),
+            'trackers': MappingProxyType({k: MappingProxyType(v) for k, v in get_trackers_config().items()}),
+            'snapshot': MappingProxyType(get_snapshot_config()),
+            'id_generator': get_id_generator(),
+            'sampling': MappingProxyType({**sampling, 'routes': MappingProxyType(dict(sampling['routes']))}),
+            'retention': MappingProxyType({**retention, 'routes': MappingProxyType(dict(retention['routes']))}),
+        }
+        values['http_fmts'] = MappingProxyType({
+            '%s.%s' % (k1, k2): tuple(get_http_tracker_fmts('%s.%s' % (k1, k2), values['http_tracker']))
+            for k1 in ('request', 'response') for k2 in ('header', 'params', 'data', 'body')
+        })
+        values['task_fmts'] = MappingProxyType({
+            'execution.%s' % k2: tuple(get_task_tracker_fmts('execution.%s' % k2, values['task_tracker']))
+            for k2 in ('header', 'params', 'data')
+        })
+        for k, v in values.items():
+            object.__setattr__(self, k, v)
+
+    def __setattr__(self, key, value):
+        raise AttributeError('TrackerSettings is immutable')
+
+
+_tracker_settings = None
+
+
+def get_tracker_settings():
+    """
+    进程内缓存的TrackerSettings, 在DJANGO_CHILIES变更(setting_changed信号)时重建
+    :return: TrackerSettings
+    """
+    global _tracker_settings
+    if _tracker_settings is None:
+        _tracker_settings = TrackerSettings()
+    return _tracker_settings
+
+
+def _on_setting_changed(setting, **kwargs):
+    global _tracker_settings
+    if setting == 'DJANGO_CHILIES':
+        _tracker_settings = None
+
+
+setting_changed.connect(_on_setting_changed)
@@ -1,26 +1,49 @@
 import datetime
-import json
+import heapq
+import itertools
 import logging
 import os
-import socket
 import sys
 import threading
+import time
 import traceback
-from copy import deepcopy
+import zlib
+from collections import deque
+from collections.abc import Mapping
 
-from . import writers
-from .settings import get_trackers_config, get_default_level, get_default_buffer_size, get_default_console, get_base_dir
-from .utils import JSONEncoder, generate_uuid, get_func
+from . import metrics, writers
+from .settings import get_base_dir, get_tracker_settings
+from .utils import generate_id, get_func, get_host_info, lazy_json_text, ProcessRegistry
 
 sys_logger = logging.getLogger('django.server')
 
-trackers_config = get_trackers_config()
-default_buffer_size = get_default_buffer_size()
-default_level = get_default_level()
-default_console = get_default_console()
 base_dir = get_base_dir()
 
 
+UNKNOWN_CALLER = ("(unknown file)", 0, "(unknown function)")
+
+# code object -> 是否为本模块的帧
+_internal_codes = {}
+# (code object, lineno) -> (filename, lineno, func name), 同一调用位置的record共享同一个tuple
+_callers = {}
+
+
+def _is_internal_code(co):
+    try:
+        return _internal_codes[co]
+    except KeyError:
+        rv = _internal_codes[co] = os.path.normcase(co.co_filename) == __file__
+        return rv
+
+
+def _stacked(kwargs):
+    """
+    经过一层包装调用时, stacklevel加1, 使_find_caller可以直接定位到调用者
+    """
+    kwargs['stacklevel'] = kwargs.get('stacklevel', 1) + 1
+    return kwargs
+
+
 def get_level_name(level):
     if level == logging.WARN:
         return 'WARN'
@@ -29,149 +52,318 @@ def get_level_name(level):
 
 
 def instance_from_settings(name, trace_id=None):
-    assert name in trackers_config, 'tracker config not exist: %s' % name
-    config = trackers_config[name]
-    cls = get_func(config['class'])
+    return registry.get(name)(trace_id=trace_id)
+
+
+class TrackerFactory(object):
+    """
+    按配置预先解析tracker类/writers/console等, 每次请求只需实例化tracker
+    """
+
+    def __init__(self, name):
+        tracker_settings = get_tracker_settings()
+        assert name in tracker_settings.trackers, 'tracker config not exist: %s' % name
+        config = tracker_settings.trackers[name]
+        self.name = name
+        self.cls = get_func(config['class'])
+        self.writers = [writers.instance_from_settings(writer_name) for writer_name in config.get('writers')]
+        self.kwargs = dict(
+            level=logging.getLevelName(config.get('level', tracker_settings.level)),
+            buffer_size=config.get('buffer_size', tracker_settings.buffer_size),
+            buffer_bytes=config.get('buffer_bytes', tracker_settings.buffer_bytes),
+            buffer_policy=config.get('buffer_policy', tracker_settings.buffer_policy),
+            capture_caller=config.get('capture_caller', tracker_settings.capture_caller),
+            console=logging.getLogger(config.get('console', tracker_settings.console)),
+        )
+
+    def __call__(self, trace_id=None):
+        return self.cls(name=self.name, trace_id=trace_id, writers=list(self.writers), **self.kwargs)
 
-    _writers = []
-    for writer_name in config.get('writers'):
-        _writers.append(writers.instance_from_settings(writer_name))
 
-    return cls(name=name,
-               trace_id=trace_id,
-               level=logging.getLevelName(config.get('level', default_level)),
-               buffer_size=config.get('buffer_size', default_buffer_size),
-               console=logging.getLogger(config.get('console', default_console)),
-               writers=_writers
-               )
+registry = ProcessRegistry(TrackerFactory)
+
+
+def is_sampled(trace_id, route=None):
+    """
+    head采样: 按trace_id的crc32决定是否采样, 同一trace_id在任何进程中的结果相同
+    :param trace_id:
+    :param route: url_name或task名, 在TRACKER.sampling.routes中配置时使用该采样率
+    :return:
+    """
+    sampling = get_tracker_settings().sampling
+    rate = sampling['routes'].get(route, sampling['rate']) if route is not None else sampling['rate']
+    if rate >= 1:
+        return True
+    if rate <= 0:
+        return False
+    return zlib.crc32(str(trace_id).encode()) < rate * 0x100000000
+
+
+# 参数为这些类型时, 格式化可以延迟到flush
+_immutable_types = frozenset((str, int, float, bool, type(None), bytes, complex,
+                              datetime.datetime, datetime.date, datetime.time, datetime.timedelta))
+
+
+def _format(message, args):
+    content = str(message)
+    if args:
+        # 与logging.LogRecord一致, 单个非空mapping参数用于%(name)s格式
+        if len(args) == 1 and isinstance(args[0], Mapping) and args[0]:
+            args = args[0]
+        try:
+            content = content % args
+        except (TypeError, ValueError, KeyError):
+            content = '%s %s' % (content, args)
+    return content
 
 
 class Logger(object):
     """
     logger
+    缓冲区同时受行数(buffer_size)和字符数(buffer_bytes, 近似字节数)限制, 溢出时按buffer_policy处理:
+        keep_head: 保留最早的行, 丢弃之后写入的行
+        keep_tail: 环形缓冲, 保留最新的行
+        keep_errors: 环形缓冲, 优先丢弃非ERROR的行
+    写入时按估算的长度限制, flush时再按格式化后的实际长度限制消息的总字符数
+    被丢弃的行数记录在dropped_lines, 并在flush时输出提示行, flush不清零dropped_lines, 由使用者(Tracker.persistent)清零
+    格式化延迟到flush时进行, 只有不可变类型(str/int/float/None/bytes/datetime等)的参数被延迟,
+    包含其他参数(dict/list/对象等)的行在写入时立即格式化, 避免记录到参数之后被修改的状态
     """
+    KEEP_HEAD = 'keep_head'
+    KEEP_TAIL = 'keep_tail'
+    KEEP_ERRORS = 'keep_errors'
 
     def __init__(self,
                  name='',
                  level=logging.NOTSET,
                  buffer_size=1,
-                 console=logging
+                 console=logging,
+                 buffer_bytes=None,
+                 buffer_policy=KEEP_HEAD,
+                 capture_caller=True
                  ):
+        assert buffer_policy in (self.KEEP_HEAD, self.KEEP_TAIL, self.KEEP_ERRORS), \
+            'invalid buffer policy: %s' % buffer_policy
         self.console = console
         # self.console.level = level
         self.name = name
-        self._buf = []
+        # 未格式化的record, keep_errors策略下ERROR级别的record单独存放于_err_buf
+        self._buf = deque()
+        self._err_buf = deque()
+        self._seq = itertools.count()
+        self._bytes = 0
+        self.dropped_lines = 0
         self.level = level
         self.buffer_size = buffer_size
+        self.buffer_bytes = buffer_bytes
+        self.buffer_policy = buffer_policy
+        self.capture_caller = capture_caller
         self.ignore_empty_lines = True
 
     @property
     def length(self):
-        return len(self._buf)
+        return len(self._buf) + len(self._err_buf)
 
     @property
     def is_empty(self):
         return self.length == 0
 
-    def debug(self, message):
+    def debug(self, message, *args, stacklevel=1):
         if self.level <= logging.DEBUG:
-            self.write(self._format(message, 'DEBUG'))
-            self.console.debug(message)
+            self._log(logging.DEBUG, message, args, stacklevel)
+            self.console.debug(message, *args)
             return True
         return False
 
-    def info(self, message):
+    def info(self, message, *args, stacklevel=1):
         if self.level <= logging.INFO:
-            self.write(self._format(message, 'INFO'))
-            self.console.info(message)
+            self._log(logging.INFO, message, args, stacklevel)
+            self.console.info(message, *args)
             return True
         return False
 
-    def warn(self, message):
+    def warn(self, message, *args, stacklevel=1):
         if self.level <= logging.WARNING:
-            self.write(self._format(message, 'WARN'))
-            self.console.warning(message)
+            self._log(logging.WARNING, message, args, stacklevel)
+            self.console.warning(message, *args)
             return True
         return False
 
-    def error(self, message):
+    def error(self, message, *args, stacklevel=1):
         if self.level <= logging.ERROR:
-            self.write(self._format(message, 'ERROR'))
-            self.console.error(message)
+            self._log(logging.ERROR, message, args, stacklevel)
+            self.console.error(message, *args)
             return True
         return False
 
     def flush(self):
-        message = '\n'.join(self._buf)
+        if self._err_buf:
+            records = heapq.merge(self._buf, self._err_buf)
+        else:
+            records = self._buf
+        records = list(records)
+        lines = [self._render(record) for record in records]
+        if self.buffer_bytes:
+            lines = self._fit(records, lines)
+        if self.dropped_lines:
+            notice = '... %s lines dropped ...' % self.dropped_lines
+            if self.buffer_policy == self.KEEP_HEAD:
+                lines.append(notice)
+            else:
+                lines.insert(0, notice)
+        message = '\n'.join(lines)
         self._buf.clear()
+        self._err_buf.clear()
+        self._bytes = 0
         return message
 
-    def write(self, content):
-        if self.length < self.buffer_size:
-            self._buf.append(content)
+    def write(self, content, level=logging.INFO):
+        """
+        写入原始行, 不带时间/级别/调用者前缀
+        :param content:
+        :param level:
+        :return:
+        """
+        self._append(time.time(), level, None, content, ())
+
+    def _log(self, level, message, args, stacklevel=1):
+        self._append(time.time(), level, self._find_caller(stacklevel + 2), message, args)
+
+    def _append(self, created, level, caller, message, args):
+        """
+        record: (seq, created, level, caller, message, args, size), 格式化延迟到flush时进行
+        """
+        if args and not all(type(arg) in _immutable_types for arg in args):
+            # 可变参数在写入时格式化
+            message = _format(message, args)
+            args = ()
+        size = self._estimate_size(caller, message, args)
+        if self.buffer_policy == self.KEEP_HEAD:
+            if self._is_full(size):
+                self.dropped_lines += 1
+                return
+        record = (next(self._seq), created, level, caller, message, args, size)
+        if self.buffer_policy == self.KEEP_ERRORS and level >= logging.ERROR:
+            self._err_buf.append(record)
         else:
-            # TODO:
-            pass
-
-    def _format(self, content, level):
-        content = str(content).strip('\n')
-        co_filename, func_lineno, co_name = self._find_caller()
-        return '[%s] %s %s:%s: [line:%s] %s' % (
-            datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S.%f')[:-4],
-            level,
-            # os.path.relpath(co_filename, base_dir),
-            # co_filename.replace(base_dir, ''),
-            co_filename,
-            co_name,
-            func_lineno,
-            content
-        )
+            self._buf.append(record)
+        self._bytes += size
+        # keep_tail/keep_errors: 淘汰最早的行, 直到满足缓冲区限制
+        while self._is_full(0) and self.length > 1:
+            evicted = (self._buf or self._err_buf).popleft()
+            self._bytes -= evicted[-1]
+            self.dropped_lines += 1
+
+    def _estimate_size(self, caller, message, args):
+        """
+        估算格式化后的长度, 避免在写入时格式化
+        """
+        size = len(message) + 1 if isinstance(message, str) else 64
+        for arg in args:
+            size += len(arg) if type(arg) in (str, bytes) else 16
+        if caller:
+            # 时间/级别前缀 + 调用者信息
+            size += 40 + len(caller[0]) + len(caller[2])
+        if self.buffer_bytes:
+            size = min(size, self.buffer_bytes)
+        return size
+
+    def _is_full(self, size):
+        if self.length + (1 if size else 0) > self.buffer_size:
+            return True
+        return bool(self.buffer_bytes) and self._bytes + size > self.buffer_bytes
 
-    def exception(self, e=None, with_stack=True):
+    def _fit(self, records, lines):
+        """
+        按格式化后的实际长度执行buffer_bytes限制, 超出时按buffer_policy丢弃整行
+        """
+        sizes = [len(line) + 1 for line in lines]
+        total = sum(sizes)
+        if total <= self.buffer_bytes:
+            return lines
+        kept = [True] * len(lines)
+        if self.buffer_policy == self.KEEP_HEAD:
+            order = range(len(lines) - 1, -1, -1)
+        elif self.buffer_policy == self.KEEP_TAIL:
+            order = range(len(lines))
+        else:
+            # 先丢弃最早的非ERROR行, 再丢弃最早的ERROR行
+            levels = [record[2] for record in records]
+            order = sorted(range(len(lines)), key=lambda i: levels[i] >= logging.ERROR)
+        for i in order:
+            if total <= self.buffer_bytes:
+                break
+            kept[i] = False
+            total -= sizes[i]
+            self.dropped_lines += 1
+        return [line for line, keep in zip(lines, kept) if keep]
+
+    def _render(self, record):
+        _, created, level, caller, message, args, _ = record
+        content = _format(message, args)
+        if caller is None:
+            line = content
+        else:
+            co_filename, func_lineno, co_name = caller
+            line = '[%s] %s %s:%s: [line:%s] %s' % (
+                datetime.datetime.fromtimestamp(created, datetime.timezone.utc).strftime(
+                    '%Y-%m-%d %H:%M:%S.%f')[:-4],
+                get_level_name(level),
+                # os.path.relpath(co_filename, base_dir),
+                # co_filename.replace(base_dir, ''),
+                co_filename,
+                co_name,
+                func_lineno,
+                content.strip('\n')
+            )
+        if self.buffer_bytes and len(line) >= self.buffer_bytes:
+            line = line[:self.buffer_bytes - 1]
+        return line
+
+    def exception(self, e=None, with_stack=True, stacklevel=1):
         if self.level <= logging.ERROR:
             if isinstance(e, Exception):
                 e_type, e_value, traceback_obj = type(e), e, e.__traceback__
             else:
                 e_type, e_value, traceback_obj = sys.exc_info()[:3]
                 if e:
-                    self.error(e)
+                    self.error(e, stacklevel=stacklevel + 1)
 
             self.console.exception(e_value)
-            title = '%s:%s' % (e_type, e_value)
-            self.error(title)
+            self.error('%s:%s', e_type, e_value, stacklevel=stacklevel + 1)
 
-            lines = [title]
             if with_stack:
-                # lines.append('ErrorStack:')
                 # self.write('ErrorStack:')
                 for line in traceback.format_exception(e_type, e_value, traceback_obj)[1:]:
-                    line = line.rstrip('\n')
-                    lines.append(line)
-                    self.write(line)
+                    self.write(line.rstrip('\n'), logging.ERROR)
             return True
 
         return False
 
-    def _find_caller(self):
+    def _find_caller(self, depth=3):
         """
         获取调用者信息, 用于记录file func lineno
+        :param depth: 调用者所在的帧深度, 由各层的stacklevel累加得到, 直接定位而不逐帧遍历
         :return:
         """
-
-        f = logging.currentframe()
-
-        if f is not None:
+        if not self.capture_caller:
+            return UNKNOWN_CALLER
+        try:
+            f = sys._getframe(depth)
+        except ValueError:
+            return UNKNOWN_CALLER
+        # stacklevel未累加时(如子类未传递), 继续跳过本模块内的帧
+        while f is not None and _is_internal_code(f.f_code):
             f = f.f_back
-        rv = "(unknown file)", 0, "(unknown function)"
-        while hasattr(f, "f_code"):
+        if f is None:
+            return UNKNOWN_CALLER
+        key = (f.f_code, f.f_lineno)
+        try:
+            return _callers[key]
+        except KeyError:
             co = f.f_code
-            filename = os.path.normcase(co.co_filename)
-            if filename == __file__:
-                f = f.f_back
-                continue
-            rv = (co.co_filename, f.f_lineno, co.co_name)
-            break
-        return rv
+            rv = _callers[key] = (co.co_filename, f.f_lineno, co.co_name)
+            return rv
 
 
 class SessionLogger(Logger):
@@ -181,8 +373,9 @@ class SessionLogger(Logger):
         self.tracker = tracker
         self.with_context = kwargs.pop('with_context', False)
         self.catch_exc = kwargs.pop('catch_exc', True)
-        self.args = deepcopy(args)
-        self.kwargs = deepcopy(kwargs)
+        # 只包含level/buffer/console等配置, 无需深拷贝
+        self.args = args
+        self.kwargs = dict(kwargs)
         self.session_level = logging.DEBUG
         self.error_payload = None
         self.has_error = False
@@ -225,17 +418,17 @@ class SessionLogger(Logger):
         self.console.exception(e_value)
 
     def debug(self, *args, **kwargs):
-        return super().debug(*args, **kwargs)
+        return super().debug(*args, **_stacked(kwargs))
 
     def info(self, *args, **kwargs):
-        res = super().info(*args, **kwargs)
+        res = super().info(*args, **_stacked(kwargs))
         if res:
             if self.session_level < logging.INFO:
                 self.set_session_level(logging.INFO)
         return res
 
     def warn(self, *args, **kwargs):
-        res = super().warn(*args, **kwargs)
+        res = super().warn(*args, **_stacked(kwargs))
         if res:
             self.has_warning = True
             if self.session_level < logging.WARN:
@@ -243,10 +436,10 @@ class SessionLogger(Logger):
         return res
 
     def warning(self, *args, **kwargs):
-        return self.warn(*args, **kwargs)
+        return self.warn(*args, **_stacked(kwargs))
 
     def error(self, *args, **kwargs):
-        res = super().error(*args, **kwargs)
+        res = super().error(*args, **_stacked(kwargs))
         if res:
             # session的has_error代表本次session的结果，由set_error函数来设置
             # 手动error/exception记录的错误，被视为warning
@@ -256,7 +449,7 @@ class SessionLogger(Logger):
         return res
 
     def exception(self, *args, **kwargs):
-        res = super().exception(*args, **kwargs)
+        res = super().exception(*args, **_stacked(kwargs))
         if res:
             # session的has_error代表本次session的结果，由set_error函数来设置
             # 手动error/exception记录的错误，被视为warning
@@ -282,7 +475,11 @@ class Tracker(object):
         self.create_time = datetime.datetime.now(datetime.timezone.utc)
         self.name = name
         self.writers = kwargs.pop('writers', [])
-        self.trace_id = kwargs.pop('trace_id', generate_uuid())
+        self.trace_id = kwargs.pop('trace_id', None) or generate_id()
+        # 未采样时不采集和持久化, 日志只输出到console
+        self.sampled = True
+        # tail retention决定不保留时只持久化概要
+        self.retained = True
         self.session = SessionLogger(self, with_context=True, *args, **kwargs)
         self.console = self.session.console
         self.context = {
@@ -305,20 +502,20 @@ class Tracker(object):
     def debug(self, *args, **kwargs):
         if kwargs.pop('new_session', False):
             with self.new_session() as session:
-                return session.debug(*args, **kwargs)
-        return self.session.debug(*args, **kwargs)
+                return session.debug(*args, **_stacked(kwargs))
+        return self.session.debug(*args, **_stacked(kwargs))
 
     def info(self, *args, **kwargs):
         if kwargs.pop('new_session', False):
             with self.new_session() as session:
-                return session.info(*args, **kwargs)
-        return self.session.info(*args, **kwargs)
+                return session.info(*args, **_stacked(kwargs))
+        return self.session.info(*args, **_stacked(kwargs))
 
     def warn(self, *args, **kwargs):
         if kwargs.pop('new_session', False):
             with self.new_session() as session:
-                return session.warn(*args, **kwargs)
-        res = self.session.warn(*args, **kwargs)
+                return session.warn(*args, **_stacked(kwargs))
+        res = self.session.warn(*args, **_stacked(kwargs))
         if res:
             self.context['has_warning'] = True
             if self.context['level'] < logging.WARN:
@@ -326,13 +523,13 @@ class Tracker(object):
         return res
 
     def warning(self, *args, **kwargs):
-        return self.warn(*args, **kwargs)
+        return self.warn(*args, **_stacked(kwargs))
 
     def error(self, *args, **kwargs):
         if kwargs.pop('new_session', False):
             with self.new_session() as session:
-                return session.error(*args, **kwargs)
-        res = self.session.error(*args, **kwargs)
+                return session.error(*args, **_stacked(kwargs))
+        res = self.session.error(*args, **_stacked(kwargs))
         if res:
             # tracker的has_error代表本次track的结果，由set_error函数来设置
             # 手动error/exception记录的错误，被视为warning
@@ -345,8 +542,8 @@ class Tracker(object):
         kwargs['with_stack'] = kwargs.get('with_stack', True)
         if kwargs.pop('new_session', False):
             with self.new_session() as session:
-                return session.exception(*args, **kwargs)
-        res = self.session.exception(*args, **kwargs)
+                return session.exception(*args, **_stacked(kwargs))
+        res = self.session.exception(*args, **_stacked(kwargs))
         if res:
             # tracker的has_error代表本次track的结果，由set_error函数来设置
             # 手动error/exception记录的错误，被视为warning
@@ -358,22 +555,82 @@ class Tracker(object):
 
     def persistent(self, session=None):
         session = session or self.session
+        tracker_metrics = metrics.tracker_metrics(self.name)
+        if not self.sampled:
+            tracker_metrics.counters['unsampled'] += 1
+            return
+        started = time.perf_counter()
         try:
-            message = self.get_message(session)
-            message = self.filter_message(message)
+            # 在构造消息之前按级别过滤writer, 没有writer接收时不构造消息
+            level = self.get_level(session)
+            enabled = []
             for writer in self.writers:
+                if writer.is_enabled_for(level):
+                    enabled.append(writer)
+                else:
+                    metrics.writer_metrics(writer.name).counters['filtered'] += 1
+            if not enabled:
+                tracker_metrics.counters['filtered'] += 1
+                return
+            fields = writers.Projection.union([writer.projection for writer in enabled])
+            message = self.get_message(session, fields)
+            # flush之后才是最终的丢弃行数
+            if session.dropped_lines:
+                tracker_metrics.counters['dropped_lines'] += session.dropped_lines
+                session.dropped_lines = 0
+            message = self.filter_message(message)
+            # 消息只编码一次, 由所有writer共享, 相同字段裁剪规则的writer共享裁剪后的编码
+            payload = writers.Payload(message)
+            for writer in enabled:
+                writer_metrics = metrics.writer_metrics(writer.name)
+                writer_started = time.perf_counter()
                 try:
-                    writer.write(message)
+                    writer.write_payload(payload)
                     writer.flush()
+                    writer_metrics.counters['written'] += 1
+                except writers.WriterUnavailable:
+                    # 已由CircuitBreakerWriter计数和限频记录
+                    writer_metrics.counters['unavailable'] += 1
                 except Exception as e:
+                    writer_metrics.counters['failed'] += 1
                     sys_logger.exception(e)
+                writer_metrics.histogram('write').observe(time.perf_counter() - writer_started)
+            tracker_metrics.counters['persisted'] += 1
+            if not self.retained:
+                tracker_metrics.counters['summarized'] += 1
         except Exception as e:
+            tracker_metrics.counters['failed'] += 1
             sys_logger.exception(e)
+        finally:
+            tracker_metrics.histogram('persistent').observe(time.perf_counter() - started)
 
     def set_trace_id(self, _id):
         self.trace_id = _id
 
-    def get_message(self, session):
+    def set_sampled(self, sampled):
+        self.sampled = sampled
+
+    def get_trace_headers(self):
+        """
+        传递给celery task的headers, 子任务沿用trace_id和采样结果
+        :return:
+        """
+        return {'_trace_id': self.trace_id, '_trace_sampled': self.sampled}
+
+    def get_level(self, session):
+        """
+        session对应消息的级别
+        :param session:
+        :return:
+        """
+        return self.context['level'] if session.with_context else session.session_level
+
+    def get_message(self, session, fields=None):
+        """
+        :param session:
+        :param fields: 已启用的writer需要的顶层字段(支持in), None为全部字段
+        :return:
+        """
         raise NotImplementedError()
 
     def filter_message(self, o):
@@ -440,6 +697,59 @@ class HTTPTracker(Tracker):
         }, user={}, operator={}))
 
         self.request_params_tracked = False
+        # tail retention开启时, 延迟执行的采集步骤
+        self.deferred = None
+
+    def defer_captures(self):
+        """
+        开启tail retention: 之后的capture只记录引用, 由set_retained决定是否执行
+        :return:
+        """
+        self.deferred = []
+
+    def capture(self, fn, *args, **kwargs):
+        """
+        执行采集步骤(复制/解码/编码等), 开启tail retention时延迟到set_retained(True)
+        :param fn:
+        :return:
+        """
+        if self.deferred is None:
+            return fn(*args, **kwargs)
+        self.deferred.append((fn, args, kwargs))
+
+    def is_retained(self, status_code, duration):
+        """
+        tail retention: 有错误或警告, http或api code为4xx/5xx, 或耗时超过slow_ms(可按url_name配置)时保留完整消息
+        :param status_code:
+        :param duration: ms
+        :return:
+        """
+        retention = get_tracker_settings().retention
+        if not retention['enabled']:
+            return True
+        if self.context['has_error'] or self.context['has_warning'] or self.context['level'] >= logging.WARN:
+            return True
+        if status_code is not None and status_code >= 400:
+            return True
+        if str(self.context['api']['code']).startswith(('4', '5')):
+            return True
+        slow_ms = retention['routes'].get(self.context['http']['url_name'], retention['slow_ms'])
+        return slow_ms is not None and duration > slow_ms
+
+    def set_retained(self, retained):
+        """
+        保留完整消息时执行延迟的采集步骤, 否则丢弃, 消息只包含概要
+        :param retained:
+        :return:
+        """
+        deferred, self.deferred = self.deferred, None
+        self.retained = retained
+        if retained and deferred:
+            for fn, args, kwargs in deferred:
+                try:
+                    fn(*args, **kwargs)
+                except Exception as e:
+                    sys_logger.exception(e)
 
     def set_request_id(self, _id):
         self.context['request']['id'] = _id
@@ -459,7 +769,8 @@ class HTTPTracker(Tracker):
         self.console.info(text)
 
     def set_request_headers(self, headers, formats=['json', 'text']):
-        text = json.dumps(headers, ensure_ascii=False, cls=JSONEncoder)
+        # text格式延迟到消息编码时才生成, 不在请求期间重复持有
+        text = lazy_json_text(headers)
         if 'json' in formats:
             self.context['request']['header'] = headers
         if 'text' in formats:
@@ -471,7 +782,7 @@ class HTTPTracker(Tracker):
         self.console.debug('RequestBody: %s', body)
 
     def set_request_params(self, params, formats=['json', 'text']):
-        text = json.dumps(params, ensure_ascii=False, cls=JSONEncoder)
+        text = lazy_json_text(params)
         if 'json' in formats:
             self.context['request']['params'] = params
         if 'text' in formats:
@@ -480,24 +791,34 @@ class HTTPTracker(Tracker):
         self.request_params_tracked = True
 
     def set_response_headers(self, headers, formats=['json', 'text']):
-        text = json.dumps(headers, ensure_ascii=False, cls=JSONEncoder)
+        text = lazy_json_text(headers)
         if 'json' in formats:
             self.context['response']['header'] = headers
         if 'text' in formats:
             self.context['response']['Header'] = text
         self.console.debug('ResponseHeader: %s', text)
 
-    def set_response_data(self, data, formats=['json', 'text']):
-        self.context['api']['code'] = data.get('code')
+    def set_api_result(self, data):
+        """
+        api code/message及对应的级别, 不复制data, 不降低warn/exception等已设置的更高级别
+        :param data:
+        :return:
+        """
+        code = data.get('code')
+        self.context['api']['code'] = code
         self.context['api']['message'] = data.get('message')
-        if str(data['code']).startswith('5'):
-            self.set_context_level(logging.ERROR)
-        elif str(data['code']).startswith('4'):
-            self.set_context_level(logging.WARN)
+        if str(code).startswith('5'):
+            level = logging.ERROR
+        elif str(code).startswith('4'):
+            level = logging.WARN
         else:
-            self.set_context_level(logging.INFO)
+            level = logging.INFO
+        if level > self.context['level']:
+            self.set_context_level(level)
 
-        text = json.dumps(data, ensure_ascii=False, cls=JSONEncoder)
+    def set_response_data(self, data, formats=['json', 'text']):
+        self.set_api_result(data)
+        text = lazy_json_text(data)
         if 'json' in formats:
             self.context['response']['data'] = data
         if 'text' in formats:
@@ -511,7 +832,7 @@ class HTTPTracker(Tracker):
     def set_http_result(self, info):
         self.context['http']['duration'] = info.get('duration')
         self.context['http']['status_code'] = info.get('status_code')
-        text = '%s %s %.1fms %s %s %s' % (
+        args = (
             self.context['http']['method'],
             self.context['http']['url'] if not self.context['http']['query_string'] else '%s?%s' % (
                 self.context['http']['url'], self.context['http']['query_string']),
@@ -521,25 +842,27 @@ class HTTPTracker(Tracker):
             self.context['api']['message'])
 
         if self.context['has_error']:
-            self.session.error(text)
+            self.session.error('%s %s %.1fms %s %s %s', *args)
         elif self.context['has_warning']:
-            self.session.warn(text)
+            self.session.warn('%s %s %.1fms %s %s %s', *args)
         else:
-            self.session.info(text)
+            self.session.info('%s %s %.1fms %s %s %s', *args)
 
     def set_user(self, user):
         if user:
             self.context['user'] = user
-        text = json.dumps(self.context['user'], ensure_ascii=False, cls=JSONEncoder)
-        self.console.debug('User: %s' % text)
+        text = lazy_json_text(self.context['user'])
+        self.console.debug('User: %s', text)
 
     def set_operator(self, operator):
         if operator:
             self.context['operator'] = operator
-        text = json.dumps(self.context['operator'], ensure_ascii=False, cls=JSONEncoder)
-        self.console.debug('Operator: %s' % text)
+        text = lazy_json_text(self.context['operator'])
+        self.console.debug('Operator: %s', text)
 
-    def get_message(self, session):
+    def get_message(self, session, fields=None):
+        # 先flush, flush时可能继续丢弃行
+        message = session.flush() if self.retained and (fields is None or 'message' in fields) else None
         msg = {
             "@version": "1",
             'type': 'HTTPTracker',
@@ -548,13 +871,20 @@ class HTTPTracker(Tracker):
             "thread_name": threading.current_thread().getName(),
             # "app": settings.APP_NAME,
             # "env_name": os.getenv('ENV_NAME', ''),
-            "hostname": socket.gethostname(),
-            "host_ip": socket.gethostbyname(socket.gethostname()),
+            **get_host_info(),
             "with_context": session.with_context,
-            "message": session.flush(),
+            "dropped_lines": session.dropped_lines,
+            "message": message,
             "status_code": self.context['http']['status_code']
         }
-        if session.with_context:
+        if session.with_context and not self.retained:
+            # 概要: 不包含日志行和header/body/params/data
+            msg['@timestamp'] = self.create_time.strftime('%Y-%m-%dT%H:%M:%S.%f%z')
+            msg['summary'] = True
+            for k in ('level', 'has_error', 'has_warning', 'error', 'attrs', 'http', 'api', 'user', 'operator'):
+                msg[k] = self.context[k]
+            msg['request'] = {'id': self.context['request']['id']}
+        elif session.with_context:
             msg['@timestamp'] = self.create_time.strftime('%Y-%m-%dT%H:%M:%S.%f%z')
             msg = {**msg, **self.context}
         else:
@@ -601,7 +931,7 @@ class TaskTracker(Tracker):
         self.console.debug('Execution ID: %s' % self.context['execution']['id'])
 
     def set_task_headers(self, headers, formats=['json', 'text']):
-        text = json.dumps(headers, ensure_ascii=False, cls=JSONEncoder)
+        text = lazy_json_text(headers)
         if 'json' in formats:
             self.context['execution']['header'] = headers
         if 'text' in formats:
@@ -609,24 +939,24 @@ class TaskTracker(Tracker):
         self.console.debug('TaskHeaders: %s', text)
 
     def set_task_params(self, params, formats=['json', 'text']):
-        text = json.dumps(params, ensure_ascii=False, cls=JSONEncoder)
+        text = lazy_json_text(params)
         if 'json' in formats:
             self.context['execution']['params'] = params
         if 'text' in formats:
             self.context['execution']['Params'] = text
-        self.console.debug('TaskParams: %s' % text)
+        self.console.debug('TaskParams: %s', text)
 
     def set_task_data(self, data, formats=['json', 'text']):
-        text = json.dumps(data, ensure_ascii=False, cls=JSONEncoder)
+        text = lazy_json_text(data)
         if 'json' in formats:
             self.context['execution']['data'] = data
         if 'text' in formats:
             self.context['execution']['Data'] = text
-        self.console.debug('TaskData: %s' % text)
+        self.console.debug('TaskData: %s', text)
 
     def set_task_result(self, info):
         self.context['execution']['duration'] = info['duration']
-        text = 'task %s.%s %.1fms' % (
+        args = (
             self.context['task']['module'],
             self.context['task']['name'],
             self.context['execution']['duration']
@@ -634,13 +964,15 @@ class TaskTracker(Tracker):
             # self.context['TaskData']
         )
         if self.context['has_error']:
-            self.session.error(text)
+            self.session.error('task %s.%s %.1fms', *args)
         elif self.context['has_warning']:
-            self.session.warn(text)
+            self.session.warn('task %s.%s %.1fms', *args)
         else:
-            self.session.info(text)
+            self.session.info('task %s.%s %.1fms', *args)
 
-    def get_message(self, session):
+    def get_message(self, session, fields=None):
+        # 先flush, flush时可能继续丢弃行
+        message = session.flush() if fields is None or 'message' in fields else None
         msg = {
             "@version": "1",
             "type": 'TaskTracker',
@@ -650,10 +982,10 @@ class TaskTracker(Tracker):
             # "level_value": None,
             # "app": settings.APP_NAME,
             # "env_name": os.getenv('ENV_NAME', ''),
-            "hostname": socket.gethostname(),
-            "host_ip": socket.gethostbyname(socket.gethostname()),
+            **get_host_info(),
             "with_context": session.with_context,
-            "message": session.flush()
+            "dropped_lines": session.dropped_lines,
+            "message": message
         }
         if session.with_context:
             msg['@timestamp'] = self.create_time.strftime('%Y-%m-%dT%H:%M:%S.%f%z')
@@ -1,19 +1,26 @@
+import atexit
 import datetime
 import hashlib
 import importlib
-import json
+import inspect
+import os
 import random
+import socket
 import traceback
 
 import django
 import sys
 import threading
 import time
+import weakref
 from functools import wraps
 import pytz
+from celery.signals import worker_process_shutdown
 
-from .common import DefaultJSONEncoder
-from .settings import get_json_encoder
+from . import codec
+from .codec import JSONEncoder
+from .common import DefaultJSONEncoder, LazyValue, get_type_handler
+from .settings import get_host_fields, get_tracker_settings
 from django.forms.utils import to_current_timezone, from_current_timezone
 from rest_framework.renderers import JSONRenderer as JRenderer
 
@@ -41,19 +48,232 @@ def get_func(func_name):
         return eval(func_name)
 
 
-je_cname = get_json_encoder()
-if je_cname == 'django_chilies.utils.JSONEncoder':
-    JSONEncoder = DefaultJSONEncoder
-else:
-    JSONEncoder = get_func(je_cname)
-
-
 class JSONRenderer(JRenderer):
+    # 由drf使用标准库编码, 保留STRICT_JSON对NaN/Infinity的检查
     encoder_class = JSONEncoder
 
 
 def deepcopy(o):
-    return json.loads(json.dumps(o, cls=JSONEncoder))
+    """
+    o的快照, 与json编码再解码的结果相同, 受TRACKER.snapshot的大小限制
+    """
+    return snapshot(o, **get_tracker_settings().snapshot)
+
+
+_json_types = frozenset((str, int, float, bool, type(None)))
+# bool是int的子类, 需要先判断
+_key_types = {bool: lambda k: 'true' if k else 'false', int: int.__repr__, float: float.__repr__,
+              type(None): lambda k: 'null'}
+# 使用DefaultJSONEncoder时直接取注册的编码函数, 省去default的调用
+_dispatch = JSONEncoder is DefaultJSONEncoder
+_default = None
+# 超过该深度时改为记录路径上的容器重新复制, 区分循环引用和嵌套很深的数据
+_CHECK_DEPTH = 64
+
+
+class _TooDeep(Exception):
+    pass
+
+
+def snapshot(o, max_depth=None, max_items=None, max_size=None):
+    """
+    json结构的快照: 只复制dict/list/tuple等容器, str/int等不可变值直接引用, 其他值按JSONEncoder编码,
+    与标准库json编码再解码的结果相同(tuple转为list, dict的key转为str), 与JSON_BACKEND无关,
+    无法编码时抛出TypeError, 循环引用抛出ValueError
+    超过限制的部分替换为截断标记:
+        max_depth: 超过深度的容器替换为'...(truncated: depth > max_depth)'
+        max_items: 每个list/dict只保留前max_items项, list末尾追加'...(n more items)', dict追加key '...'
+        max_size: 按近似的json字节数计算, 用完后剩余的项不再复制, 字符串被截断
+    :return:
+    """
+    global _default
+    if _default is None:
+        _default = JSONEncoder().default
+    if max_depth is None and max_items is None and max_size is None:
+        try:
+            return _copy(o, 0)
+        except _TooDeep:
+            pass
+    return _Snapshot(max_depth, max_items, max_size).copy(o, 0)
+
+
+def _copy(o, depth):
+    """
+    不记录路径, 深度超过_CHECK_DEPTH时抛出_TooDeep
+    """
+    return (_copiers.get(type(o)) or _copier(type(o)))(o, depth)
+
+
+def _copy_dict(o, depth):
+    # 先整体复制再替换非json值, 比逐项构造dict快
+    if depth > _CHECK_DEPTH:
+        raise _TooDeep()
+    depth += 1
+    result = o.copy()
+    str_keys = True
+    for k, v in result.items():
+        if type(v) not in _json_types:
+            result[k] = (_copiers.get(type(v)) or _copier(type(v)))(v, depth)
+        if type(k) is not str:
+            str_keys = False
+    if str_keys:
+        return result
+    return {k if type(k) is str else _key(k): v for k, v in result.items()}
+
+
+def _copy_mapping(o, depth):
+    # dict的子类(OrderedDict/ReturnDict等)的copy返回子类, 逐项构造dict
+    if depth > _CHECK_DEPTH:
+        raise _TooDeep()
+    depth += 1
+    return {k if type(k) is str else _key(k): v if type(v) in _json_types else _copy(v, depth)
+            for k, v in o.items()}
+
+
+def _copy_list(o, depth):
+    if depth > _CHECK_DEPTH:
+        raise _TooDeep()
+    depth += 1
+    result = list(o)
+    for i, v in enumerate(result):
+        if type(v) not in _json_types:
+            result[i] = (_copiers.get(type(v)) or _copier(type(v)))(v, depth)
+    return result
+
+
+def _copy_encoded(o, depth):
+    o = _encode(o)
+    return o if type(o) in _json_types else _copy(o, depth)
+
+
+# 类型 -> 复制函数
+_copiers = {t: lambda o, depth: o for t in _json_types}
+_copiers.update({dict: _copy_dict, list: _copy_list, tuple: _copy_list})
+
+
+def _copier(t):
+    # 与json的判断顺序一致, str/int/float的子类按基类编码
+    if issubclass(t, str):
+        fn = lambda o, depth: str.__str__(o)  # noqa: E731
+    elif issubclass(t, int):
+        fn = lambda o, depth: int.__int__(o)  # noqa: E731
+    elif issubclass(t, float):
+        fn = lambda o, depth: float.__float__(o)  # noqa: E731
+    elif issubclass(t, (list, tuple)):
+        fn = _copy_list
+    elif issubclass(t, dict):
+        fn = _copy_mapping
+    else:
+        fn = _copy_encoded
+    _copiers[t] = fn
+    return fn
+
+
+def _encode(o):
+    handler = get_type_handler(o.__class__) if _dispatch else None
+    return handler(o) if handler is not None else _default(o)
+
+
+def _enter(o, path):
+    i = id(o)
+    if i in path:
+        raise ValueError('Circular reference detected')
+    path.add(i)
+    return i
+
+
+def _copy_leaf(o, state, copy):
+    # str/int/float的子类按基类编码, 其他值按JSONEncoder编码后再复制
+    if isinstance(o, str):
+        return str.__str__(o)
+    if isinstance(o, int):
+        return int.__int__(o)
+    if isinstance(o, float):
+        return float.__float__(o)
+    return copy(_encode(o), state)
+
+
+def _key(k):
+    if isinstance(k, str):
+        return str.__str__(k)
+    for t, fn in _key_types.items():
+        if isinstance(k, t):
+            return fn(k)
+    raise TypeError('keys must be str, int, float, bool or None, not %s' % k.__class__.__name__)
+
+
+class _Snapshot(object):
+    """
+    带大小限制的snapshot
+    """
+    __slots__ = ('max_depth', 'max_items', 'remaining', 'path')
+
+    def __init__(self, max_depth, max_items, max_size):
+        self.max_depth = max_depth
+        self.max_items = max_items
+        self.remaining = max_size
+        self.path = set()
+
+    def copy(self, o, depth):
+        t = type(o)
+        if t in _json_types:
+            return o if self.remaining is None else self._sized(o)
+        is_dict = isinstance(o, dict)
+        if is_dict or isinstance(o, (list, tuple)):
+            if self.max_depth is not None and depth >= self.max_depth:
+                return '...(truncated: depth > %s)' % self.max_depth
+            i = _enter(o, self.path)
+            result = self._copy_dict(o, depth + 1) if is_dict else self._copy_list(o, depth + 1)
+            self.path.discard(i)
+            return result
+        return _copy_leaf(o, depth, self.copy)
+
+    def _copy_dict(self, o, depth):
+        result = {}
+        limit = self.max_items
+        for i, (k, v) in enumerate(o.items()):
+            if limit is not None and i >= limit or self.remaining is not None and self.remaining <= 0:
+                result['...'] = '(%s more keys)' % (len(o) - i)
+                break
+            if type(k) is not str:
+                k = _key(k)
+            if self.remaining is not None:
+                self.remaining -= len(k) + 4
+            result[k] = self.copy(v, depth)
+        return result
+
+    def _copy_list(self, o, depth):
+        result = []
+        limit = self.max_items
+        for i, v in enumerate(o):
+            if limit is not None and i >= limit or self.remaining is not None and self.remaining <= 0:
+                result.append('...(%s more items)' % (len(o) - i))
+                break
+            result.append(self.copy(v, depth))
+        return result
+
+    def _sized(self, o):
+        if type(o) is str:
+            # dict的key可能已用完预算, remaining <= 0时不再保留字符串的内容
+            if o and len(o) + 2 > self.remaining:
+                n = max(self.remaining - 2, 0)
+                self.remaining = 0
+                return '%s...(truncated: %s chars)' % (o[:n], len(o) - n)
+            self.remaining -= len(o) + 3
+        else:
+            self.remaining -= 8
+        return o
+
+
+def json_text(o):
+    return codec.dumps(o, compact=False)
+
+
+def lazy_json_text(o):
+    """
+    o的json文本, 直到被编码或str时才生成
+    """
+    return LazyValue(json_text, o)
 
 
 def headers_dict(headers):
@@ -92,6 +312,237 @@ def generate_uuid(value=None, rand=True, uppercase=True, length=32):
     return uuid
 
 
+def _hook_ref(func):
+    # 绑定方法只保存弱引用, 对象被回收后回调随之失效, 不会因为注册而常驻内存
+    if inspect.ismethod(func):
+        return weakref.WeakMethod(func)
+    return lambda: func
+
+
+def _prune(refs, predicate):
+    """
+    原地删除失效的和predicate(func)为真的回调
+    :return: 被删除的有效回调, 按注册顺序
+    """
+    removed = []
+    kept = []
+    for ref in refs:
+        func = ref()
+        if func is None:
+            continue
+        if predicate(func):
+            removed.append(func)
+        else:
+            kept.append(ref)
+    refs[:] = kept
+    return removed
+
+
+_hooks_lock = threading.Lock()
+_fork_funcs = []
+
+
+def register_after_fork(func):
+    """
+    注册fork后在子进程中执行的函数, 用于重置进程级的状态(线程/连接/缓存等)
+    按注册顺序执行, 绑定方法只保存弱引用
+    """
+    with _hooks_lock:
+        _prune(_fork_funcs, lambda f: False)
+        _fork_funcs.append(_hook_ref(func))
+    return func
+
+
+def unregister_after_fork(func):
+    with _hooks_lock:
+        _prune(_fork_funcs, lambda f: f == func)
+
+
+def _run_after_fork():
+    global _hooks_lock
+    # fork时其他线程可能持有锁, 子进程中需要新建
+    _hooks_lock = threading.Lock()
+    for ref in list(_fork_funcs):
+        func = ref()
+        if func is not None:
+            try:
+                func()
+            except Exception:
+                traceback.print_exc()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_run_after_fork)
+
+
+_exit_funcs = []
+
+
+def register_at_exit(func):
+    """
+    注册进程退出时执行的函数, 用于flush/关闭writer的缓冲
+    celery prefork子进程由os._exit退出, 不执行atexit, 在worker_process_shutdown信号中同样执行
+    与atexit一致, 后注册的先执行, 每个函数只执行一次; 绑定方法只保存弱引用
+    """
+    with _hooks_lock:
+        _prune(_exit_funcs, lambda f: False)
+        _exit_funcs.append(_hook_ref(func))
+    return func
+
+
+def unregister_at_exit(func):
+    with _hooks_lock:
+        _prune(_exit_funcs, lambda f: f == func)
+
+
+def unregister_hooks(obj):
+    """
+    注销obj的绑定方法注册的fork/退出回调, 用于替换下来不再使用的对象
+    :param obj:
+    :return: 被注销的退出回调, 按执行顺序(后注册的在前), 由调用方决定是否立即执行
+    """
+    def bound_to(func):
+        return getattr(func, '__self__', None) is obj
+
+    with _hooks_lock:
+        _prune(_fork_funcs, bound_to)
+        return _prune(_exit_funcs, bound_to)[::-1]
+
+
+@atexit.register
+def _run_exit_funcs(**kwargs):
+    while _exit_funcs:
+        func = _exit_funcs.pop()()
+        if func is None:
+            continue
+        try:
+            func()
+        except Exception:
+            traceback.print_exc()
+
+
+worker_process_shutdown.connect(_run_exit_funcs, weak=False)
+
+
+_host_info = None
+
+
+def get_host_info():
+    """
+    进程级的主机信息, 只计算一次, 避免每条消息都做DNS解析
+    静态字段由DJANGO_CHILIES['TRACKER']['host_fields']扩展
+    :return:
+    """
+    global _host_info
+    if _host_info is None:
+        hostname = socket.gethostname()
+        try:
+            host_ip = socket.gethostbyname(hostname)
+        except OSError:
+            host_ip = None
+        _host_info = {'hostname': hostname, 'host_ip': host_ip, **get_host_fields()}
+    return _host_info
+
+
+@register_after_fork
+def reset_host_info():
+    global _host_info
+    _host_info = None
+
+
+class ProcessRegistry(object):
+    """
+    进程级的懒加载注册表, 按key缓存builder(key)创建的对象
+    TRACKER配置变更(get_tracker_settings返回新对象)或fork后, 缓存失效并重新创建
+    配置变更时替换下的对象交给release(对象)释放, 如关闭writer并注销其回调
+    """
+
+    def __init__(self, builder, release=None):
+        self.builder = builder
+        self.release = release
+        self._items = {}
+        self._settings = None
+        self._lock = threading.Lock()
+        register_after_fork(self.reset)
+
+    def get(self, key):
+        tracker_settings = get_tracker_settings()
+        if self._settings is not tracker_settings:
+            replaced = {}
+            with self._lock:
+                if self._settings is not tracker_settings:
+                    replaced = self._items
+                    self._items = {}
+                    self._settings = tracker_settings
+            if self.release is not None:
+                for item in replaced.values():
+                    self.release(item)
+        try:
+            return self._items[key]
+        except KeyError:
+            with self._lock:
+                if key not in self._items:
+                    self._items[key] = self.builder(key)
+                return self._items[key]
+
+    def items(self):
+        """
+        当前进程已创建的(key, 对象)
+        :return:
+        """
+        return list(self._items.items())
+
+    def reset(self):
+        # fork时其他线程可能持有锁, 子进程中需要新建
+        self._lock = threading.Lock()
+        self._items = {}
+        self._settings = None
+
+
+class TimeOrderedId(object):
+    """
+    单调递增且按时间有序的128位id(UUIDv7布局), 32位小写hex
+    高48位为毫秒时间戳, 其后12位为同一毫秒内的序号, 低62位随机
+    同一毫秒内超过4096个或时钟回拨时借用下一毫秒, 保证进程内严格递增
+    fork后重置锁和随机数种子, 父子进程不会生成相同的id
+    """
+
+    def __init__(self):
+        self.reset()
+        register_after_fork(self.reset)
+
+    def reset(self):
+        self._lock = threading.Lock()
+        self._random = random.Random()
+        self._last = 0
+
+    def __call__(self):
+        with self._lock:
+            tick = max(time.time_ns() // 1000000 << 12, self._last + 1)
+            self._last = tick
+            rand = self._random.getrandbits(62)
+        # version 7, variant 0b10
+        return '%032x' % ((tick >> 12) << 80 | 0x7000 << 64 | (tick & 0xfff) << 64 | 0x8000000000000000 | rand)
+
+
+time_ordered_id = TimeOrderedId()
+
+_id_generator = (None, None)
+
+
+def generate_id():
+    """
+    由DJANGO_CHILIES['ID_GENERATOR']生成request/trace/execution id, 默认为time_ordered_id
+    :return:
+    """
+    global _id_generator
+    tracker_settings = get_tracker_settings()
+    if _id_generator[0] is not tracker_settings:
+        path = tracker_settings.id_generator
+        _id_generator = (tracker_settings, get_func(path) if isinstance(path, str) else path)
+    return _id_generator[1]()
+
+
 def singleton_class(post_init=None):
     def _dec(cls):
         def _init(func):
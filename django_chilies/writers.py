@@ -1,38 +1,232 @@
-import json
+import fcntl
+import gzip
+import itertools
 import logging
+import os
+import queue
+import mmap
+import shutil
+import socket
+import struct
 import sys
+import threading
+import time
+from collections import Counter, deque
 
 from kafka import KafkaProducer
-from kafka.errors import NoBrokersAvailable
+from kafka.errors import KafkaTimeoutError, NoBrokersAvailable
 
 from .utils import trace_error
-from .settings import get_writers_config, get_default_level
-from .utils import singleton_class, get_func, JSONEncoder
-
-writers_config = get_writers_config()
-default_level = get_default_level()
+from .settings import get_tracker_settings
+from .common import resolve_lazy
+from . import codec
+from .utils import singleton_class, get_func, ProcessRegistry, register_after_fork, register_at_exit, unregister_hooks
 
 default_logger = logging.getLogger('django.server')
 
 
 def instance_from_settings(name):
+    """
+    writer不保存请求相关的状态, 每个进程按名称只创建一次
+    """
+    return registry.get(name)
+
+
+def build_writer(name):
+    writers_config = get_tracker_settings().writers
     assert name in writers_config, 'writer config not exist: %s' % name
-    config = writers_config[name]
+    config = dict(writers_config[name])
+    breaker_config = config.pop('circuit_breaker', None)
+    spool_config = config.pop('spool', None)
+    async_config = config.pop('async', None)
     cls = get_func(config['class'])
 
     if 'level' not in config:
-        return cls(name=name, level=default_level, **config)
+        writer = cls(name=name, level=get_tracker_settings().level, **config)
     else:
-        return cls(name=name, **config)
+        writer = cls(name=name, **config)
+
+    if breaker_config:
+        if breaker_config is True:
+            breaker_config = {}
+        writer = CircuitBreakerWriter(writer, **breaker_config)
+    if spool_config:
+        writer = SpoolWriter(writer, **spool_config)
+    if async_config:
+        if async_config is True:
+            async_config = {}
+        writer = AsyncWriter(writer, **async_config)
+    return writer
+
+
+def release_writer(writer):
+    """
+    配置变更后替换下的writer: 由外到内逐层注销fork/退出回调, 并立即执行其退出回调(flush/关闭)
+    注销后不再被回调持有, 进程退出时也不会再次执行
+    """
+    while writer is not None:
+        for func in unregister_hooks(writer):
+            try:
+                func()
+            except Exception as e:
+                default_logger.exception(e)
+        writer = getattr(writer, 'writer', None)
+
+
+registry = ProcessRegistry(build_writer, release_writer)
+
+
+def encode_message(o):
+    """
+    tracker消息的标准编码: 紧凑的utf-8 json
+    """
+    return codec.dumpb(o)
+
+
+class Projection(object):
+    """
+    writer需要的消息字段, fields为保留的字段, exclude_fields为去掉的字段, 都支持点号分隔的嵌套字段(如request.Body)
+    在编码前裁剪消息, 被去掉的LazyValue不会被计算
+    """
+    __slots__ = ('fields', 'exclude_fields', 'key')
+
+    def __init__(self, fields=None, exclude_fields=None):
+        self.fields = self._tree(fields) if fields is not None else None
+        self.exclude_fields = self._tree(exclude_fields or ())
+        # 相同裁剪规则的writer共享同一个Payload
+        self.key = (tuple(sorted(fields)) if fields is not None else None, tuple(sorted(exclude_fields or ())))
+
+    def __contains__(self, field):
+        """
+        顶层字段是否需要
+        :param field:
+        :return:
+        """
+        if self.fields is not None and field not in self.fields:
+            return False
+        return field not in self.exclude_fields or self.exclude_fields[field] is not None
+
+    def apply(self, message):
+        if self.fields is not None:
+            message = self._include(message, self.fields)
+        if self.exclude_fields:
+            message = self._exclude(message, self.exclude_fields)
+        return message
+
+    @staticmethod
+    def _tree(paths):
+        # 字段路径 -> 嵌套dict, 叶子为None
+        tree = {}
+        for path in paths:
+            node = tree
+            parts = path.split('.')
+            for part in parts[:-1]:
+                child = node.get(part, {})
+                if child is None:
+                    break
+                node = node.setdefault(part, child)
+            else:
+                node[parts[-1]] = None
+        return tree
+
+    @classmethod
+    def _include(cls, o, tree):
+        result = {}
+        for k, sub in tree.items():
+            if k in o:
+                v = o[k]
+                result[k] = v if sub is None or not isinstance(v, dict) else cls._include(v, sub)
+        return result
+
+    @classmethod
+    def _exclude(cls, o, tree):
+        result = dict(o)
+        for k, sub in tree.items():
+            if k in result:
+                if sub is None:
+                    del result[k]
+                elif isinstance(result[k], dict):
+                    result[k] = cls._exclude(result[k], sub)
+        return result
+
+    @staticmethod
+    def union(projections):
+        """
+        多个writer需要的顶层字段的并集, 任一writer需要全部字段时返回None
+        :param projections: list of Projection or None
+        :return:
+        """
+        if any(p is None for p in projections):
+            return None
+        return _ProjectionUnion(projections)
+
+
+class _ProjectionUnion(object):
+    __slots__ = ('projections',)
+
+    def __init__(self, projections):
+        self.projections = projections
+
+    def __contains__(self, field):
+        return any(field in p for p in self.projections)
+
+
+class Payload(object):
+    """
+    一条待写入的tracker消息, 编码结果在所有writer之间共享, 最多编码一次
+    message中可能包含LazyValue, 在编码时计算; 接收dict的writer使用resolved
+    """
+    __slots__ = ('message', '_encoded', '_resolved', '_projected')
+
+    def __init__(self, message, encoded=None):
+        self.message = message
+        self._encoded = encoded
+        self._resolved = None
+        self._projected = None
+
+    def project(self, projection):
+        """
+        按projection裁剪后的Payload, 相同的裁剪规则只裁剪和编码一次
+        :param projection: Projection or None
+        :return:
+        """
+        if projection is None:
+            return self
+        if self._projected is None:
+            self._projected = {}
+        payload = self._projected.get(projection.key)
+        if payload is None:
+            payload = self._projected[projection.key] = Payload(projection.apply(self.message))
+        return payload
+
+    @property
+    def level(self):
+        return self.message.get('level')
+
+    @property
+    def resolved(self):
+        if self._resolved is None:
+            self._resolved = resolve_lazy(self.message)
+        return self._resolved
+
+    @property
+    def encoded(self):
+        if self._encoded is None:
+            self._encoded = encode_message(self.message)
+        return self._encoded
 
 
 class Writer(object):
+    # write接收的格式: 'message'为消息dict, 'bytes'为encode_message编码后的bytes
+    accepts = 'message'
 
-    def __init__(self, name='', level=logging.NOTSET, *args, **kwargs):
+    def __init__(self, name='', level=logging.NOTSET, fields=None, exclude_fields=None, *args, **kwargs):
         if not isinstance(level, int):
             level = logging.getLevelName(level)
         self.level = level
         self.name = name
+        # None为需要全部字段
+        self.projection = Projection(fields, exclude_fields) if fields is not None or exclude_fields else None
 
     def write(self, o):
         raise NotImplementedError()
@@ -45,45 +239,1291 @@ class Writer(object):
     def flush(self):
         raise NotImplementedError()
 
+    def close(self):
+        self.flush()
+
+    def is_available(self):
+        """
+        to be override, writer当前是否可以写入, 如broker是否已连接
+        :return:
+        """
+        return True
+
+    def set_failure_handler(self, handler):
+        """
+        to be override, 异步投递失败时以编码后的消息调用handler(data), 同步写入的writer直接抛出异常
+        :param handler:
+        :return:
+        """
+
+    def delivery_failures(self):
+        """
+        to be override, 异步投递失败的累计次数
+        :return:
+        """
+        return 0
+
+    def wait_delivered(self, timeout=None):
+        """
+        to be override, 等待已写入的消息投递完成, 超时返回False
+        :param timeout:
+        :return:
+        """
+        self.flush()
+        return True
+
+    def write_payload(self, payload):
+        """
+        按accepts声明的格式写入, 同一个payload只会被编码一次
+        :param payload: Payload
+        :return:
+        """
+        level = payload.level
+        if level and not self.is_enabled_for(level):
+            return
+        payload = payload.project(self.projection)
+        if self.accepts == 'bytes':
+            self.write(payload.encoded)
+        else:
+            self.write(payload.resolved)
+
+
+class AsyncWriter(Writer):
+    """
+    包装任意writer, write只负责入队, 由后台线程按批次写入并flush
+    批次大小由batch_size限制, 批次等待时间由flush_interval(秒)限制
+    队列满时, overflow='drop'直接丢弃, overflow='block'最多等待block_timeout秒后丢弃
+    """
+    OVERFLOW_DROP = 'drop'
+    OVERFLOW_BLOCK = 'block'
+
+    _STOP = object()
+
+    def __init__(self, writer, queue_size=10000, batch_size=100, flush_interval=1.0,
+                 overflow=OVERFLOW_DROP, block_timeout=None, close_timeout=5.0):
+        assert overflow in (self.OVERFLOW_DROP, self.OVERFLOW_BLOCK), 'invalid overflow policy: %s' % overflow
+        super().__init__(name=writer.name, level=writer.level)
+        # 由被包装的writer裁剪, tracker据此计算需要的字段
+        self.projection = writer.projection
+        self.writer = writer
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self.close_timeout = close_timeout
+        self.counters = Counter()
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        register_at_exit(self.close)
+
+    def _ensure_started(self):
+        # fork之后子进程中没有后台线程, 需要重新创建队列和线程
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue(maxsize=self.queue_size)
+                self._thread = threading.Thread(target=self._run, name='AsyncWriter-%s' % self.name, daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def write(self, o):
+        if isinstance(o, dict):
+            self.write_payload(Payload(o))
+        else:
+            self._put(o)
+
+    def write_payload(self, payload):
+        level = payload.level
+        if level and not self.is_enabled_for(level):
+            return
+        self._put(payload)
+
+    def _put(self, o):
+        self._ensure_started()
+        try:
+            if self.overflow == self.OVERFLOW_BLOCK:
+                self._queue.put(o, timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait(o)
+        except queue.Full:
+            self.counters['dropped'] += 1
+
+    def flush(self):
+        """
+        由后台线程flush, 此处不阻塞调用方
+        :return:
+        """
+
+    def close(self):
+        if self._pid != os.getpid() or not self._thread.is_alive():
+            return
+        try:
+            self._queue.put(self._STOP, timeout=self.close_timeout)
+        except queue.Full:
+            return
+        self._thread.join(self.close_timeout)
+
+    def _run(self):
+        q = self._queue
+        stopped = False
+        while not stopped:
+            item = q.get()
+            if item is self._STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = q.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is self._STOP:
+                    stopped = True
+                    break
+                batch.append(item)
+            self._write_batch(batch)
+
+    def _write_batch(self, batch):
+        for o in batch:
+            try:
+                if isinstance(o, Payload):
+                    self.writer.write_payload(o)
+                else:
+                    self.writer.write(o)
+                self.counters['written'] += 1
+            except WriterUnavailable:
+                self.counters['failed'] += 1
+            except Exception as e:
+                self.counters['failed'] += 1
+                default_logger.exception(e)
+        try:
+            self.writer.flush()
+        except WriterUnavailable:
+            pass
+        except Exception as e:
+            default_logger.exception(e)
+
+
+class WriterUnavailable(Exception):
+    """
+    writer暂时不可用
+    """
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class SpoolWriter(Writer):
+    """
+    包装任意writer, writer不可用或写入失败时, 将编码后的消息追加到directory下的segment文件(每行一条)
+    segment超过segment_bytes后滚动, 每fsync_batch条或每fsync_interval秒fsync一次
+    writer恢复后, 后台线程按segment创建顺序回放, 回放速率不超过replay_rate(条/秒), 避免积压冲垮sink
+    回放期间的新消息直接写入writer, 只保证segment内的顺序, 回放中断时剩余消息重新入队(至少一次)
+    回放完成后最多等待delivery_timeout秒确认投递, 未确认或有投递失败时保留整个segment稍后重新回放
+    异步投递失败的消息(如KafkaWriter的回调)同样写入segment
+    每个进程创建后或第一次写入时检查directory, 有遗留的segment时启动回放线程
+    """
+    ACTIVE = '.active'
+    READY = '.ready'
+    REPLAYING = '.replaying-'
+
+    def __init__(self, writer, directory, segment_bytes=64 * 1024 * 1024, fsync_batch=100, fsync_interval=1.0,
+                 replay_rate=500, check_interval=5.0, delivery_timeout=30.0):
+        super().__init__(name=writer.name, level=writer.level)
+        # 由被包装的writer裁剪, tracker据此计算需要的字段
+        self.projection = writer.projection
+        self.writer = writer
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync_batch = fsync_batch
+        self.fsync_interval = fsync_interval
+        self.replay_rate = replay_rate
+        self.check_interval = check_interval
+        self.delivery_timeout = delivery_timeout
+        self.counters = Counter()
+        self._segment = None
+        self._segment_path = None
+        self._segment_size = 0
+        self._unsynced = 0
+        self._synced_at = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._checked_pid = None
+        os.makedirs(directory, exist_ok=True)
+        writer.set_failure_handler(self.spool)
+        register_at_exit(self.close)
+        self._check_leftover()
+
+    def write_payload(self, payload):
+        self._check_leftover()
+        level = payload.level
+        if level and not self.is_enabled_for(level):
+            return
+        if self.writer.is_available():
+            try:
+                self.writer.write_payload(payload)
+                return
+            except WriterUnavailable:
+                pass
+            except Exception as e:
+                default_logger.exception(e)
+        self.spool(payload.project(self.projection).encoded)
+
+    def write(self, o):
+        if isinstance(o, dict):
+            self.write_payload(Payload(o))
+            return
+        self._check_leftover()
+        if self.writer.is_available():
+            try:
+                self._write_encoded(o)
+                return
+            except WriterUnavailable:
+                pass
+            except Exception as e:
+                default_logger.exception(e)
+        self.spool(o)
+
+    def _write_encoded(self, data):
+        if self.writer.accepts == 'bytes':
+            self.writer.write(data)
+        else:
+            self.writer.write(codec.loads(data))
+
+    def flush(self):
+        try:
+            self.writer.flush()
+        except WriterUnavailable:
+            pass
+
+    def close(self):
+        with self._lock:
+            self._close_segment()
+
+    def spool(self, data):
+        self._ensure_replayer()
+        with self._lock:
+            if self._segment is None:
+                self._segment_path = os.path.join(self.directory, '%s.%020d.%s%s' % (
+                    self.name, time.time_ns(), os.getpid(), self.ACTIVE))
+                self._segment = open(self._segment_path, 'ab')
+                self._segment_size = 0
+            self._segment.write(data)
+            self._segment.write(b'\n')
+            self._segment_size += len(data) + 1
+            self._unsynced += 1
+            self.counters['spooled'] += 1
+            if self._segment_size >= self.segment_bytes:
+                self._close_segment()
+            elif self._unsynced >= self.fsync_batch or time.monotonic() - self._synced_at >= self.fsync_interval:
+                self._fsync()
+
+    def _fsync(self):
+        self._segment.flush()
+        os.fsync(self._segment.fileno())
+        self._unsynced = 0
+        self._synced_at = time.monotonic()
+
+    def _close_segment(self):
+        """
+        关闭当前segment, 并标记为可回放
+        """
+        if self._segment is None or self._pid != os.getpid():
+            return
+        self._fsync()
+        self._segment.close()
+        os.replace(self._segment_path, self._segment_path[:-len(self.ACTIVE)] + self.READY)
+        self._segment = None
+        self._segment_path = None
+
+    def _check_leftover(self):
+        """
+        每个进程检查一次遗留的segment(之前的进程未回放完的ready/replaying/active文件), 有则启动回放线程
+        """
+        if self._checked_pid == os.getpid():
+            return
+        self._checked_pid = os.getpid()
+        try:
+            if self._segments():
+                self._ensure_replayer()
+        except OSError as e:
+            default_logger.exception(e)
+
+    def _ensure_replayer(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                # fork继承的segment属于父进程, 子进程重新创建
+                # 只关闭底层fd, 继承的缓冲由父进程写入
+                if self._segment is not None:
+                    self._segment.raw.close()
+                self._segment = None
+                self._segment_path = None
+                self._thread = threading.Thread(target=self._run, name='SpoolWriter-%s' % self.name, daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            time.sleep(self.check_interval)
+            try:
+                if self.writer.is_available():
+                    with self._lock:
+                        self._close_segment()
+                    self._replay_all()
+                elif self._segment is not None and self._unsynced:
+                    with self._lock:
+                        if self._segment is not None:
+                            self._fsync()
+            except Exception as e:
+                default_logger.exception(e)
+
+    def _segments(self):
+        """
+        可回放的segment, 包括已退出进程遗留的active/replaying文件
+        """
+        prefix = self.name + '.'
+        names = []
+        for filename in sorted(os.listdir(self.directory)):
+            if not filename.startswith(prefix):
+                continue
+            path = os.path.join(self.directory, filename)
+            if filename.endswith(self.READY):
+                names.append(path)
+            elif filename.endswith(self.ACTIVE):
+                pid = filename[:-len(self.ACTIVE)].rsplit('.', 1)[-1]
+                if not _pid_alive(int(pid)):
+                    names.append(path)
+            elif self.REPLAYING in filename:
+                try:
+                    pid = int(filename.rsplit(self.REPLAYING, 1)[-1].split('.', 1)[0])
+                except ValueError:
+                    continue
+                if _pid_alive(pid):
+                    continue
+                if filename.endswith('.tmp'):
+                    # _requeue中断时遗留的临时文件, 原replaying文件仍然完整
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                else:
+                    names.append(path)
+        return names
+
+    def _replay_all(self):
+        for path in self._segments():
+            claimed = path.rsplit('.', 1)[0] + self.REPLAYING + str(os.getpid())
+            try:
+                os.rename(path, claimed)
+            except FileNotFoundError:
+                # 被其他进程认领
+                continue
+            if not self._replay(claimed):
+                return
+
+    def _replay(self, path):
+        started = time.monotonic()
+        replayed = 0
+        failures = self.writer.delivery_failures()
+        with open(path, 'rb') as f:
+            for line in f:
+                data = line.rstrip(b'\n')
+                if not data:
+                    continue
+                try:
+                    if not self.writer.is_available():
+                        raise WriterUnavailable(self.name)
+                    self._write_encoded(data)
+                except Exception as e:
+                    if not isinstance(e, WriterUnavailable):
+                        default_logger.exception(e)
+                    self._requeue(path, data, f)
+                    return False
+                replayed += 1
+                self.counters['replayed'] += 1
+                if self.replay_rate:
+                    delay = started + replayed / self.replay_rate - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+        # 确认投递后才删除segment
+        if not self.writer.wait_delivered(self.delivery_timeout) or self.writer.delivery_failures() != failures:
+            self.counters['replay_unconfirmed'] += 1
+            os.replace(path, path.rsplit(self.REPLAYING, 1)[0] + self.READY)
+            return False
+        os.remove(path)
+        return True
+
+    def _requeue(self, path, data, f):
+        """
+        回放中断, 未回放的消息写回原segment位置(文件名保持创建顺序)
+        """
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as out:
+            out.write(data)
+            out.write(b'\n')
+            for line in f:
+                out.write(line)
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(tmp, path.rsplit(self.REPLAYING, 1)[0] + self.READY)
+        os.remove(path)
+
 
 # @singleton_class()
+class CircuitBreakerWriter(Writer):
+    """
+    包装任意writer, 写入失败或耗时超过latency_budget(秒)都记为失败
+    最近window次调用中至少有min_calls次且失败比例达到failure_rate时熔断, open_seconds秒内直接跳过writer,
+    之后放行一次探测写入(half-open), 成功则恢复, 失败则继续熔断; 非closed状态下flush直接拒绝, 不作为探测
+    被跳过和失败的调用抛出WriterUnavailable, 不打印traceback, 失败日志每log_interval秒最多一条
+    熔断期间is_available返回False, 外层的SpoolWriter会将消息写入磁盘
+    注意: 无法中断正在阻塞的调用, 需要严格限制请求路径上的耗时时应再包装AsyncWriter
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, writer, latency_budget=0.1, failure_rate=0.5, min_calls=20, window=100, open_seconds=30.0,
+                 log_interval=60.0):
+        super().__init__(name=writer.name, level=writer.level)
+        self.projection = writer.projection
+        self.accepts = writer.accepts
+        self.writer = writer
+        self.latency_budget = latency_budget
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.open_seconds = open_seconds
+        self.log_interval = log_interval
+        self.state = self.CLOSED
+        self.counters = Counter()
+        # 最近的调用结果, True为成功
+        self._window = deque(maxlen=window)
+        self._failures = 0
+        self._opened_at = 0
+        self._logged_at = None
+        self._suppressed = 0
+        self._lock = threading.Lock()
+
+    def write_payload(self, payload):
+        level = payload.level
+        if level and not self.is_enabled_for(level):
+            return
+        self._call(self.writer.write_payload, payload)
+
+    def write(self, o):
+        self._call(self.writer.write, o)
+
+    def flush(self):
+        if self.state != self.CLOSED:
+            # flush(如KafkaWriter)可能不接触sink, 只有写入可以作为探测调用
+            raise WriterUnavailable(self.name)
+        self._call(self.writer.flush, counted=False)
+
+    def close(self):
+        self.writer.close()
+
+    def set_failure_handler(self, handler):
+        self.writer.set_failure_handler(handler)
+
+    def delivery_failures(self):
+        return self.writer.delivery_failures()
+
+    def wait_delivered(self, timeout=None):
+        return self.writer.wait_delivered(timeout)
+
+    def is_available(self):
+        if self.state == self.OPEN and time.monotonic() - self._opened_at < self.open_seconds:
+            return False
+        return self.writer.is_available()
+
+    def _call(self, func, *args, counted=True):
+        if not self._allow():
+            if counted:
+                self.counters['rejected'] += 1
+            raise WriterUnavailable(self.name)
+        started = time.monotonic()
+        try:
+            func(*args)
+        except Exception as e:
+            self.counters['failed'] += 1
+            self._record(False, '%s failed: %r' % (func.__name__, e))
+            raise WriterUnavailable(self.name) from e
+        elapsed = time.monotonic() - started
+        if self.latency_budget and elapsed > self.latency_budget:
+            self.counters['slow'] += 1
+            self._record(False, '%s took %.1fms, budget %.1fms' % (
+                func.__name__, elapsed * 1000, self.latency_budget * 1000))
+        elif counted:
+            # 成功的flush不计入窗口, 避免稀释写入的失败率
+            self.counters['written'] += 1
+            self._record(True)
+
+    def _allow(self):
+        if self.state == self.CLOSED:
+            return True
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.open_seconds:
+                # 只放行一次探测调用
+                self.state = self.HALF_OPEN
+                return True
+            return self.state == self.CLOSED
+
+    def _record(self, ok, error=None):
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                if ok:
+                    self.state = self.CLOSED
+                    self._window.clear()
+                    self._failures = 0
+                    default_logger.warning('writer %s circuit closed', self.name)
+                else:
+                    self._open(error)
+                return
+            if self.state == self.OPEN:
+                return
+            if len(self._window) == self._window.maxlen and not self._window[0]:
+                self._failures -= 1
+            self._window.append(ok)
+            if ok:
+                return
+            self._failures += 1
+            if len(self._window) >= self.min_calls and self._failures >= self.failure_rate * len(self._window):
+                self._open(error)
+            else:
+                self._log_failure(error)
+
+    def _open(self, error):
+        self.state = self.OPEN
+        self._opened_at = time.monotonic()
+        self.counters['opened'] += 1
+        default_logger.warning('writer %s circuit opened for %ss, last error: %s', self.name, self.open_seconds, error)
+
+    def _log_failure(self, error):
+        now = time.monotonic()
+        if self._logged_at is not None and now - self._logged_at < self.log_interval:
+            self._suppressed += 1
+            return
+        if self._suppressed:
+            default_logger.warning('writer %s %s (%s similar errors suppressed)', self.name, error, self._suppressed)
+        else:
+            default_logger.warning('writer %s %s', self.name, error)
+        self._logged_at = now
+        self._suppressed = 0
+
+
 class KafkaWriter(Writer):
+    """
+    producer在进程内按writer名称共享(线程安全), fork后在子进程中重新创建, 进程退出时flush并关闭
+    broker不可用时不会永久放弃, 按retry_interval指数退避(最长max_retry_interval秒)重新连接
+    投递失败后同样按retry_interval指数退避, 期间is_available返回False, 外层的SpoolWriter将消息写入磁盘,
+    投递失败的消息交给failure_handler(由SpoolWriter设置)
+
+    消息以trace_id为key发送, 同一trace的消息落在同一partition, 保持顺序
+    linger_ms/batch_size/compression_type为producer的批量发送配置
+    max_in_flight限制未确认的消息数, 超出时最多等待in_flight_timeout秒, 仍超出则丢弃
+    投递结果由回调计入counters: sent/delivered/failed/dropped/unavailable
+    flush默认不阻塞(Tracker每条消息都会调用), sync=True时等待所有消息投递完成(最长flush_timeout秒)
+    """
     _producers = {}
+    _producers_lock = threading.Lock()
 
-    def __init__(self, name='', producer=None, topic=None, level=None, *args, **kwargs):
+    def __init__(self, name='', producer=None, topic=None, level=None, retry_interval=1.0, max_retry_interval=60.0,
+                 linger_ms=None, batch_size=None, compression_type=None, max_in_flight=10000, in_flight_timeout=0,
+                 sync=False, flush_timeout=10.0, producer_class=None, *args, **kwargs):
         super().__init__(name=name, level=level, *args, **kwargs)
         self.topic = topic
-        if name in self._producers:
-            self.producer = self._producers[name]
-        else:
+        producer = dict(producer or {})
+        # 配置了value_serializer时, 由producer自行编码消息dict, 否则直接发送共享的编码结果
+        self.value_serializer = producer.pop('value_serializer', None)
+        self.accepts = 'message' if self.value_serializer else 'bytes'
+        for k, v in (('linger_ms', linger_ms), ('batch_size', batch_size), ('compression_type', compression_type)):
+            if v is not None:
+                producer[k] = v
+        self.producer_config = producer
+        self.producer_class = get_func(producer_class) if isinstance(producer_class, str) else producer_class
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.in_flight_timeout = in_flight_timeout
+        self.sync = sync
+        self.flush_timeout = flush_timeout
+        self.max_in_flight = max_in_flight
+        self.counters = Counter()
+        self._in_flight = threading.BoundedSemaphore(max_in_flight)
+        register_after_fork(self._reset_in_flight)
+        self._connect_failures = 0
+        self._next_connect = 0
+        self._delivery_failures = 0
+        self._unavailable_until = 0
+        self.failure_handler = None
+        self.get_producer()
+
+    @property
+    def producer(self):
+        return self.get_producer()
+
+    def get_producer(self):
+        producer = self._producers.get(self.name)
+        if producer is not None or time.monotonic() < self._next_connect:
+            return producer
+        with self._producers_lock:
+            producer = self._producers.get(self.name)
+            if producer is None and time.monotonic() >= self._next_connect:
+                try:
+                    producer = (self.producer_class or KafkaProducer)(**self.producer_config)
+                except NoBrokersAvailable:
+                    trace_error(logger=default_logger)
+                    self._connect_failures += 1
+                    self._next_connect = time.monotonic() + min(
+                        self.retry_interval * 2 ** (self._connect_failures - 1), self.max_retry_interval)
+                    return None
+                self._connect_failures = 0
+                self._producers[self.name] = producer
+        return producer
+
+    def is_available(self):
+        return time.monotonic() >= self._unavailable_until and self.get_producer() is not None
+
+    def set_failure_handler(self, handler):
+        self.failure_handler = handler
+
+    def delivery_failures(self):
+        return self.counters['failed']
+
+    def wait_delivered(self, timeout=None):
+        producer = self._producers.get(self.name)
+        if producer is None:
+            return self.in_flight == 0
+        try:
+            producer.flush(timeout=self.flush_timeout if timeout is None else timeout)
+        except KafkaTimeoutError:
+            return False
+        return True
+
+    @classmethod
+    def reset_producers(cls):
+        """
+        fork后子进程中继承的producer, 其socket和io线程均不可用, 直接丢弃
+        """
+        cls._producers_lock = threading.Lock()
+        cls._producers = {}
+
+    def _reset_in_flight(self):
+        # fork时父进程中未确认的消息不会在子进程中回调, 信号量和计数需要重置
+        self._in_flight = threading.BoundedSemaphore(self.max_in_flight)
+        self.counters = Counter()
+
+    @classmethod
+    def close_producers(cls, timeout=5.0):
+        with cls._producers_lock:
+            producers, cls._producers = cls._producers, {}
+        for producer in producers.values():
             try:
-                self.producer = KafkaProducer(**producer)
-                self._producers[name] = self.producer
-            except NoBrokersAvailable:
-                trace_error(logger=default_logger)
-                self.producer = None
+                producer.flush(timeout=timeout)
+                producer.close(timeout=timeout)
+            except Exception as e:
+                default_logger.exception(e)
+
+    def write_payload(self, payload):
+        level = payload.level
+        if level and not self.is_enabled_for(level):
+            return
+        key = payload.message.get('trace_id')
+        payload = payload.project(self.projection)
+        if self.accepts == 'bytes':
+            self._send(payload.encoded, key)
+        else:
+            self._send(self.value_serializer(payload.resolved), key)
 
     def write(self, o):
-        if not self.producer:
+        key = None
+        if not isinstance(o, bytes):
+            level = o.get('level')
+            if level and not self.is_enabled_for(level):
+                return
+            key = o.get('trace_id')
+            o = self.value_serializer(o) if self.value_serializer else encode_message(o)
+        self._send(o, key)
+
+    def _send(self, value, key=None):
+        producer = self.get_producer()
+        if not producer:
+            self.counters['unavailable'] += 1
             return
-        level = o.get('level')
-        if level and not self.is_enabled_for(level):
+        if self.in_flight_timeout:
+            acquired = self._in_flight.acquire(timeout=self.in_flight_timeout)
+        else:
+            acquired = self._in_flight.acquire(blocking=False)
+        if not acquired:
+            self.counters['dropped'] += 1
+            return
+        self.counters['sent'] += 1
+        try:
+            future = producer.send(self.topic, value=value, key=str(key).encode('utf-8') if key is not None else None)
+        except Exception:
+            self._in_flight.release()
+            self.counters['failed'] += 1
+            raise
+        future.add_callback(self._on_delivered)
+        future.add_errback(self._on_failed, value)
+
+    def _on_delivered(self, metadata):
+        self._in_flight.release()
+        self.counters['delivered'] += 1
+        self._delivery_failures = 0
+
+    def _on_failed(self, value, e):
+        self._in_flight.release()
+        self.counters['failed'] += 1
+        self._delivery_failures += 1
+        self._unavailable_until = time.monotonic() + min(
+            self.retry_interval * 2 ** (self._delivery_failures - 1), self.max_retry_interval)
+        # value_serializer的编码无法回放, 只处理共享的json编码
+        if self.failure_handler is not None and self.accepts == 'bytes':
+            try:
+                self.failure_handler(value)
+            except Exception as handler_error:
+                default_logger.exception(handler_error)
+
+    @property
+    def in_flight(self):
+        return self.counters['sent'] - self.counters['delivered'] - self.counters['failed']
+
+    def flush(self, timeout=None):
+        """
+        sync=False时不阻塞; 指定timeout或sync=True时, 等待已发送的消息投递完成
+        :param timeout:
+        :return:
+        """
+        if timeout is None and not self.sync:
             return
-        self.producer.send(self.topic, o)
+        producer = self._producers.get(self.name)
+        if producer:
+            producer.flush(timeout=self.flush_timeout if timeout is None else timeout)
+
+    def close(self):
+        self.flush(timeout=self.flush_timeout)
+
+
+register_after_fork(KafkaWriter.reset_producers)
+register_at_exit(KafkaWriter.close_producers)
+
+
+class _IntervalFlusher(object):
+    """
+    后台线程, 在mark(写入缓冲)之后最多interval秒调用一次flush, 空闲时不唤醒
+    fork后在子进程中重新创建线程
+    """
+
+    def __init__(self, name, interval, flush):
+        self.name = name
+        self.interval = interval
+        self.flush = flush
+        self._event = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def mark(self):
+        if self._pid != os.getpid():
+            self._start()
+        if not self._event.is_set():
+            self._event.set()
+
+    def _start(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._event = threading.Event()
+                threading.Thread(target=self._run, args=(self._event,), name=self.name, daemon=True).start()
+                self._pid = os.getpid()
+
+    def _run(self, event):
+        while True:
+            event.wait()
+            time.sleep(self.interval)
+            # 先清除再flush, flush期间的写入在下一轮刷出
+            event.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                default_logger.exception(e)
+
+
+class FileWriter(Writer):
+    """
+    以NDJSON(每行一条紧凑json)追加写入directory下的文件, 使用buffer_size字节的用户态缓冲
+    每个进程写自己的文件({filename}.{pid}.{创建时间}[.n].ndjson), 多个gunicorn worker可共享同一目录
+    文件超过max_bytes或打开超过rotate_interval秒后滚动, 关闭的文件由后台线程gzip压缩
+    后台线程在写入后最多flush_interval秒刷出缓冲并fsync(fsync=False时不fsync), flush_interval为0时每次flush都刷盘
+    进程退出时关闭文件
+    """
+    accepts = 'bytes'
+
+    def __init__(self, name='', level=None, directory='.', filename=None, buffer_size=1024 * 1024,
+                 max_bytes=256 * 1024 * 1024, rotate_interval=3600, compress=True, flush_interval=1.0, fsync=True,
+                 *args, **kwargs):
+        super().__init__(name=name, level=level, *args, **kwargs)
+        self.directory = directory
+        self.filename = filename or name
+        self.buffer_size = buffer_size
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.compress = compress
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self._file = None
+        self._path = None
+        self._size = 0
+        self._opened_at = 0
+        self._pid = None
+        self._flusher = _IntervalFlusher('FileWriter-flush-%s' % name, flush_interval, self._flush) \
+            if flush_interval else None
+        self._lock = threading.Lock()
+        self._compress_queue = None
+        os.makedirs(directory, exist_ok=True)
+        register_at_exit(self.close)
+
+    def write(self, o):
+        if not isinstance(o, bytes):
+            level = o.get('level')
+            if level and not self.is_enabled_for(level):
+                return
+            o = encode_message(o)
+        with self._lock:
+            if self._pid != os.getpid():
+                # fork继承的文件属于父进程, 子进程写自己的文件
+                # 只关闭底层fd, 继承的缓冲由父进程写入, 子进程不能再刷出
+                if self._file is not None:
+                    self._file.raw.close()
+                self._file = None
+                self._compress_queue = None
+                self._pid = os.getpid()
+            if self._file is None:
+                self._open()
+            elif self._size >= self.max_bytes or time.monotonic() - self._opened_at >= self.rotate_interval:
+                self._rotate()
+            self._file.write(o)
+            self._file.write(b'\n')
+            self._size += len(o) + 1
+        if self._flusher is not None:
+            self._flusher.mark()
 
     def flush(self):
         """
+        flush_interval为0时立即刷盘, 否则由后台线程刷盘, 不阻塞调用方
+        :return:
+        """
+        if not self.flush_interval:
+            self._flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None and self._pid == os.getpid():
+                self._sync()
+                self._file.close()
+                self._file = None
+
+    def _flush(self):
+        with self._lock:
+            if self._file is not None and self._pid == os.getpid():
+                self._sync()
+
+    def _sync(self):
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+    def _open(self):
+        base = os.path.join(self.directory, '%s.%s.%s' % (self.filename, os.getpid(), time.strftime('%Y%m%d%H%M%S')))
+        # 同一秒内多次滚动时追加序号, 不与刚滚动的文件重名
+        path = base + '.ndjson'
+        n = 0
+        while os.path.exists(path) or os.path.exists(path + '.gz'):
+            n += 1
+            path = '%s.%s.ndjson' % (base, n)
+        self._path = path
+        self._file = open(self._path, 'ab', buffering=self.buffer_size)
+        self._size = 0
+        self._opened_at = time.monotonic()
+
+    def _rotate(self):
+        self._sync()
+        self._file.close()
+        closed = self._path
+        self._open()
+        if self.compress:
+            if self._compress_queue is None:
+                self._compress_queue = queue.Queue()
+                threading.Thread(target=self._compress_loop, args=(self._compress_queue,),
+                                 name='FileWriter-%s' % self.name, daemon=True).start()
+            self._compress_queue.put(closed)
+
+    def _compress_loop(self, q):
+        while True:
+            path = q.get()
+            try:
+                with open(path, 'rb') as src, gzip.open(path + '.gz', 'wb') as dst:
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
+                os.remove(path)
+            except Exception as e:
+                default_logger.exception(e)
+
+
+class SharedRing(object):
+    """
+    基于mmap文件(通常在/dev/shm下)的多进程共享环形缓冲, 多个进程写入, 单个进程读取
+    文件头: magic, capacity, head(写入总字节数), tail(读取总字节数), dropped; 每条记录为4字节长度+数据
+    写入和移动tail时持有文件的flock, 读取数据不持锁: tail到head之间的数据在被读取前不会被覆盖
+    空间不足时丢弃新写入的记录并计数
+    """
+    MAGIC = b'CHILIRNG'
+    HEADER = struct.Struct('<8sQQQQ')
+    LENGTH = struct.Struct('<I')
+
+    def __init__(self, path, capacity=64 * 1024 * 1024):
+        self.path = path
+        self.capacity = capacity
+        self._fd = None
+        self._mm = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def open(self):
+        """
+        打开(必要时创建)共享文件, fork后需要重新打开: flock属于打开的文件, 父子进程共享同一个文件时互不排斥
         :return:
         """
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            header = os.pread(fd, self.HEADER.size, 0)
+            if len(header) == self.HEADER.size and header[:8] == self.MAGIC:
+                self.capacity = self.HEADER.unpack(header)[1]
+            else:
+                os.ftruncate(fd, self.HEADER.size + self.capacity)
+                os.pwrite(fd, self.HEADER.pack(self.MAGIC, self.capacity, 0, 0, 0), 0)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        self._mm = mmap.mmap(fd, self.HEADER.size + self.capacity)
+        self._fd = fd
+        self._pid = os.getpid()
+
+    def close(self):
+        if self._mm is not None and self._pid == os.getpid():
+            self._mm.close()
+            os.close(self._fd)
+        self._mm = None
+        self._fd = None
+
+    def put(self, data):
+        """
+        :param data: bytes
+        :return: 是否写入, 空间不足时返回False
+        """
+        size = self.LENGTH.size + len(data)
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reopen()
+            mm = self._mm
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                magic, capacity, head, tail, dropped = self.HEADER.unpack_from(mm, 0)
+                if capacity - (head - tail) < size:
+                    self.HEADER.pack_into(mm, 0, magic, capacity, head, tail, dropped + 1)
+                    return False
+                self._copy_in(head, self.LENGTH.pack(len(data)))
+                self._copy_in(head + self.LENGTH.size, data)
+                self.HEADER.pack_into(mm, 0, magic, capacity, head + size, tail, dropped)
+                return True
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def get(self, max_records=1000):
+        """
+        读取最多max_records条记录, 只能由一个进程调用
+        :param max_records:
+        :return: list of bytes
+        """
+        if self._pid != os.getpid():
+            self._reopen()
+        head, tail = self._positions()
+        records = []
+        pos = tail
+        while pos < head and len(records) < max_records:
+            length = self.LENGTH.unpack(self._copy_out(pos, self.LENGTH.size))[0]
+            records.append(self._copy_out(pos + self.LENGTH.size, length))
+            pos += self.LENGTH.size + length
+        if pos != tail:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                magic, capacity, head, _, dropped = self.HEADER.unpack_from(self._mm, 0)
+                self.HEADER.pack_into(self._mm, 0, magic, capacity, head, pos, dropped)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        return records
+
+    @property
+    def dropped(self):
+        if self._pid != os.getpid():
+            self._reopen()
+        return self.HEADER.unpack_from(self._mm, 0)[4]
+
+    def _reopen(self):
+        if self._mm is not None:
+            # 继承的fd与父进程共享同一个打开的文件, flock无法互斥, 关闭后重新打开
+            self._mm.close()
+            os.close(self._fd)
+        self.open()
+
+    def _positions(self):
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            _, _, head, tail, _ = self.HEADER.unpack_from(self._mm, 0)
+            return head, tail
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _copy_in(self, pos, data):
+        offset = pos % self.capacity
+        first = min(len(data), self.capacity - offset)
+        start = self.HEADER.size + offset
+        if first == len(data):
+            self._mm[start:start + first] = data
+        else:
+            self._mm[start:start + first] = data[:first]
+            self._mm[self.HEADER.size:self.HEADER.size + len(data) - first] = data[first:]
+
+    def _copy_out(self, pos, length):
+        offset = pos % self.capacity
+        first = min(length, self.capacity - offset)
+        start = self.HEADER.size + offset
+        data = self._mm[start:start + first]
+        if first < length:
+            data += self._mm[self.HEADER.size:self.HEADER.size + length - first]
+        return data
+
+
+class RingWriter(Writer):
+    """
+    将编码后的消息写入共享内存环形缓冲, 请求路径上只有一次内存拷贝
+    由tracker_shipper命令启动的单个进程读取并转发到writers中配置的writer, 每台主机只需要一组broker连接
+    缓冲满时丢弃消息, 丢弃数记录在共享文件头和counters中
+    """
+    accepts = 'bytes'
+
+    def __init__(self, name='', level=None, path=None, size=64 * 1024 * 1024, writers=None, *args, **kwargs):
+        super().__init__(name=name, level=level, *args, **kwargs)
+        self.path = path or '/dev/shm/django_chilies.%s' % name
+        # shipper转发的目标writer名称
+        self.writers = list(writers or [])
+        self.ring = SharedRing(self.path, size)
+        self.counters = Counter()
+
+    def write(self, o):
+        if not isinstance(o, bytes):
+            level = o.get('level')
+            if level and not self.is_enabled_for(level):
+                return
+            o = encode_message(o)
+        if self.ring.put(o):
+            self.counters['written'] += 1
+        else:
+            self.counters['dropped'] += 1
+
+    def flush(self):
+        # 写入即对shipper可见
+        pass
+
+    def close(self):
+        self.ring.close()
+
+
+class DatagramWriter(Writer):
+    """
+    以数据报将编码后的消息发送给本机的日志agent, address为unix socket路径或(host, port)的UDP地址
+    发送不阻塞, socket缓冲已满时丢弃消息并计数; 超过max_datagram字节的消息按GELF格式分片:
+    每片12字节头(0x1e 0x0f, 8字节消息id, 序号, 总片数), 最多128片
+    unix socket的接收队列长度受net.unix.max_dgram_qlen限制, 消息较多时需要调大
+    """
+    accepts = 'bytes'
+    CHUNK_MAGIC = b'\x1e\x0f'
+    CHUNK_HEADER = struct.Struct('>2s8sBB')
+    MAX_CHUNKS = 128
+
+    def __init__(self, name='', level=None, address=None, max_datagram=65000, *args, **kwargs):
+        super().__init__(name=name, level=level, *args, **kwargs)
+        assert address, 'address is required'
+        if isinstance(address, str):
+            self.family = socket.AF_UNIX
+            self.address = address
+        else:
+            self.family = socket.AF_INET6 if ':' in address[0] else socket.AF_INET
+            self.address = tuple(address)
+        self.max_datagram = max_datagram
+        self.counters = Counter()
+        self._sock = None
+        self._ids = itertools.count()
+
+    @property
+    def sock(self):
+        if self._sock is None:
+            sock = socket.socket(self.family, socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            self._sock = sock
+        return self._sock
+
+    def write(self, o):
+        if not isinstance(o, bytes):
+            level = o.get('level')
+            if level and not self.is_enabled_for(level):
+                return
+            o = encode_message(o)
+        try:
+            if len(o) <= self.max_datagram:
+                self.sock.sendto(o, self.address)
+            else:
+                for chunk in self._chunks(o):
+                    self.sock.sendto(chunk, self.address)
+        except BlockingIOError:
+            # agent处理不及, socket缓冲已满
+            self.counters['dropped'] += 1
+        except OSError as e:
+            # agent未启动等
+            self.counters['failed'] += 1
+            default_logger.debug('%s send failed: %s', self.name, e)
+        else:
+            self.counters['sent'] += 1
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def _chunks(self, data):
+        size = self.max_datagram - self.CHUNK_HEADER.size
+        total = (len(data) + size - 1) // size
+        if total > self.MAX_CHUNKS:
+            raise OSError('message too large: %s bytes' % len(data))
+        # pid区分fork后的子进程
+        message_id = struct.pack('>II', os.getpid() & 0xffffffff, next(self._ids) & 0xffffffff)
+        for i in range(total):
+            header = self.CHUNK_HEADER.pack(self.CHUNK_MAGIC, message_id, i, total)
+            yield header + data[i * size:(i + 1) * size]
+
+
+class DatagramReceiver(object):
+    """
+    DatagramWriter的简单接收端, 用于测试和调试, 重组分片后返回完整的消息
+    """
+
+    def __init__(self, address, buffer_size=65536):
+        if isinstance(address, str):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            if os.path.exists(address):
+                os.remove(address)
+        else:
+            address = tuple(address)
+            self.sock = socket.socket(socket.AF_INET6 if ':' in address[0] else socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(address)
+        self.address = self.sock.getsockname()
+        self.buffer_size = buffer_size
+        # message id -> {序号: 数据}
+        self._chunks = {}
+
+    def receive(self, timeout=None):
+        """
+        :param timeout: 秒, None为一直等待
+        :return: 编码后的消息bytes, 超时返回None
+        """
+        self.sock.settimeout(timeout)
+        while True:
+            try:
+                data = self.sock.recv(self.buffer_size)
+            except socket.timeout:
+                return None
+            if not data.startswith(DatagramWriter.CHUNK_MAGIC):
+                return data
+            _, message_id, seq, total = DatagramWriter.CHUNK_HEADER.unpack_from(data)
+            if message_id not in self._chunks and len(self._chunks) >= 1000:
+                # 部分分片被丢弃的消息永远无法重组, 丢弃最早的
+                del self._chunks[next(iter(self._chunks))]
+            chunks = self._chunks.setdefault(message_id, {})
+            chunks[seq] = data[DatagramWriter.CHUNK_HEADER.size:]
+            if len(chunks) == total:
+                del self._chunks[message_id]
+                return b''.join(chunks[i] for i in range(total))
+
+    def close(self):
+        if self.sock.family == socket.AF_UNIX and os.path.exists(self.address):
+            os.remove(self.address)
+        self.sock.close()
 
 
 class SystemWriter(Writer):
-    def __init__(self, name='', level=None, redirect_stderr=False, *args, **kwargs):
+    """
+    写入stdout/stderr, ERROR及以上级别写入stderr(redirect_stderr时都写入stdout)
+    format='pretty'为缩进的多行json; format='ndjson'为每行一条紧凑json, 在内存中缓冲后用os.write写入fd,
+    适合容器中由日志采集器逐行解析stdout的场景
+    flush_interval为0时每条消息都刷出, 否则由后台线程在写入后最多flush_interval秒刷出, 缓冲超过buffer_size字节时立即刷出
+    """
+    PRETTY = 'pretty'
+    NDJSON = 'ndjson'
+
+    def __init__(self, name='', level=None, redirect_stderr=False, format=PRETTY, buffer_size=64 * 1024,
+                 flush_interval=0, *args, **kwargs):
         super().__init__(name=name, level=level, *args, **kwargs)
+        assert format in (self.PRETTY, self.NDJSON), 'unknown format: %s' % format
         self.redirect_stderr = redirect_stderr
+        self.format = format
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        if format == self.NDJSON:
+            self.accepts = 'bytes'
+        # fd -> bytearray
+        self._buffers = {}
+        self._flushed_at = 0
+        self._flusher = _IntervalFlusher('SystemWriter-flush-%s' % name, flush_interval, self._flush) \
+            if flush_interval and format == self.NDJSON else None
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        register_at_exit(self.close)
+
+    def write_payload(self, payload):
+        if self.format != self.NDJSON:
+            return super().write_payload(payload)
+        level = payload.level
+        if level:
+            if not isinstance(level, int):
+                level = logging.getLevelName(level)
+            if not self.is_enabled_for(level):
+                return
+        self._write_line(self._get_stream(level), payload.project(self.projection).encoded)
 
     def write(self, o):
-        out = sys.stdout
+        if isinstance(o, bytes):
+            if self.format == self.NDJSON:
+                self._write_line(sys.stdout, o)
+            else:
+                sys.stdout.write(o.decode('utf-8') + '\n')
+            return
 
         level = o.get('level')
         if level:
@@ -91,13 +1531,68 @@ class SystemWriter(Writer):
                 level = logging.getLevelName(level)
             if not self.is_enabled_for(level):
                 return
-            if level >= logging.ERROR:
-                out = sys.stderr
 
-        if self.redirect_stderr:
-            out = sys.stdout
-        out.write(json.dumps(o, indent=2, ensure_ascii=False, cls=JSONEncoder))
+        out = self._get_stream(level)
+        if self.format == self.NDJSON:
+            self._write_line(out, encode_message(o))
+        else:
+            out.write(codec.dumps(o, indent=2) + '\n')
 
     def flush(self):
+        if self._flusher is not None:
+            # ndjson的缓冲由后台线程刷出
+            return
+        if self.flush_interval and time.monotonic() - self._flushed_at < self.flush_interval:
+            return
+        self._flush()
+
+    def close(self):
+        self._flush()
+
+    def _get_stream(self, level):
+        if level and not self.redirect_stderr and isinstance(level, int) and level >= logging.ERROR:
+            return sys.stderr
+        return sys.stdout
+
+    def _write_line(self, stream, data):
+        try:
+            fd = stream.fileno()
+        except (AttributeError, ValueError):
+            # 被替换为StringIO等没有fd的stream
+            stream.write(data.decode('utf-8') + '\n')
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                # fork继承的缓冲由父进程写出
+                self._buffers = {}
+                self._pid = os.getpid()
+            buf = self._buffers.get(fd)
+            if buf is None:
+                buf = self._buffers[fd] = bytearray()
+            buf += data
+            buf += b'\n'
+            if len(buf) >= self.buffer_size:
+                self._drain(fd, buf)
+        if self._flusher is not None:
+            self._flusher.mark()
+
+    def _flush(self):
+        # 先刷出python层的缓冲, 保持与print等输出的顺序
         sys.stdout.flush()
         sys.stderr.flush()
+        with self._lock:
+            if self._pid == os.getpid():
+                for fd, buf in self._buffers.items():
+                    if buf:
+                        self._drain(fd, buf)
+            self._flushed_at = time.monotonic()
+
+    @staticmethod
+    def _drain(fd, buf):
+        try:
+            with memoryview(buf) as view:
+                written = 0
+                while written < len(view):
+                    written += os.write(fd, view[written:])
+        finally:
+            del buf[:]
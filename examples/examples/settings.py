@@ -9,7 +9,6 @@ https://docs.djangoproject.com/en/3.0/topics/settings/
 For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.0/ref/settings/
 """
-import json
 import os
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
@@ -36,6 +35,7 @@ INSTALLED_APPS = [
     'django.contrib.messages',
     'django.contrib.staticfiles',
     'rest_framework',  # add for examples
+    'django_chilies',  # add for examples, provides the tracker_shipper command
     'bookstore'  # add for examples
 ]
 
@@ -71,6 +71,10 @@ DJANGO_CHILIES = {  # add for examples
         'buffer_size': 1000,
         'level': 'INFO',
         'console': 'django',  # default console logger
+        'host_fields': {  # computed once per process, attached to every message
+            'app_name': 'examples',
+            'env_name': os.getenv('ENV_NAME', ''),
+        },
         'http_tracker': {
             'tracker': 'http-tracker',
             'request': ['header', 'Header', 'Body', 'params', 'Params'],
@@ -85,16 +89,62 @@ DJANGO_CHILIES = {  # add for examples
                 'class': 'django_chilies.writers.KafkaWriter',
                 'level': 'INFO',
                 'topic': 'tracker',
+                'exclude_fields': ['request.Body', 'response.Body'],  # or 'fields': [...] to keep only some fields
+                'linger_ms': 50,  # producer batching
+                'compression_type': 'gzip',
+                'max_in_flight': 10000,  # unacknowledged messages, extra messages are dropped
+                'circuit_breaker': {  # skip the writer while it keeps failing, spool kicks in meanwhile
+                    'latency_budget': 0.1,  # seconds, slower writes count as failures
+                    'failure_rate': 0.5,
+                    'min_calls': 20,
+                    'open_seconds': 30,  # then let one probe write through
+                },
+                'spool': {  # spill to disk while kafka is unavailable, replay when it recovers
+                    'directory': os.path.join(BASE_DIR, 'spool'),
+                    'segment_bytes': 64 * 1024 * 1024,
+                    'replay_rate': 500,  # messages per second
+                },
+                'async': {  # write in background thread, flush in batches
+                    'queue_size': 10000,
+                    'batch_size': 100,
+                    'flush_interval': 1,
+                    'overflow': 'drop',  # drop or block
+                },
                 'producer': {
                     'bootstrap_servers': ['127.0.0.1:9092'],
                     'security_protocol': 'PLAINTEXT',
-                    'value_serializer': lambda msg: json.dumps(msg, ensure_ascii=False).encode("utf-8"),
                 }
             },
             'console-writer': {
                 'class': 'django_chilies.writers.SystemWriter',
                 'level': 'INFO',
-                'redirect_stderr': True
+                'redirect_stderr': True,
+                'format': 'pretty',  # pretty or ndjson (one compact line per message)
+                'flush_interval': 0,  # seconds, 0 flushes every message
+            },
+            'ring-writer': {  # shared memory buffer, drained by `python manage.py tracker_shipper ring-writer`
+                'class': 'django_chilies.writers.RingWriter',
+                'level': 'INFO',
+                'path': '/dev/shm/django_chilies.examples',
+                'size': 64 * 1024 * 1024,  # messages are dropped when the buffer is full
+                'writers': ['kafka'],  # writers the shipper forwards to
+            },
+            'datagram-writer': {  # datagrams to a local log agent
+                'class': 'django_chilies.writers.DatagramWriter',
+                'level': 'INFO',
+                'address': '/var/run/log-agent.sock',  # unix socket path, or ['127.0.0.1', 5140] for udp
+                'max_datagram': 65000,  # larger messages are sent in GELF chunks
+            },
+            'file-writer': {  # ndjson files for a log shipper (filebeat/vector)
+                'class': 'django_chilies.writers.FileWriter',
+                'level': 'INFO',
+                'directory': os.path.join(BASE_DIR, 'logs'),
+                'filename': 'tracker',  # tracker.{pid}.{time}.ndjson
+                'buffer_size': 1024 * 1024,
+                'max_bytes': 256 * 1024 * 1024,  # rotate by size
+                'rotate_interval': 3600,  # rotate by time, seconds
+                'compress': True,  # gzip rotated files in background
+                'flush_interval': 1,
             }
         },
         'trackers': {
@@ -111,6 +161,7 @@ DJANGO_CHILIES = {  # add for examples
                 'class': 'libs.trackers.CustomTaskTracker',
                 'level': 'INFO',
                 'buffer_size': 1000,
+                'buffer_policy': 'keep_errors',  # long tasks keep the failure when buffer overflows
                 'console': 'console-logger',  # console logger
                 'writers': ['console-writer']
             }
@@ -16,7 +16,10 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 
+from django_chilies.metrics import metrics_view
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('bookstore/', include('bookstore.urls', namespace='bookstore')),
+    path('metrics', metrics_view),  # tracker/writer self-metrics of this process
 ]
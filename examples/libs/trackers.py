@@ -1,17 +1,17 @@
-from django.conf import settings
-
 from django_chilies.trackers import HTTPTracker, TaskTracker
 
 
 class CustomHTTPTracker(HTTPTracker):
+    """
+    static fields like app_name come from DJANGO_CHILIES['TRACKER']['host_fields'],
+    override filter_message only for fields that change per message
+    """
 
     def filter_message(self, o):
-        o['app_name'] = settings.APP_NAME
         return o
 
 
 class CustomTaskTracker(TaskTracker):
 
     def filter_message(self, o):
-        o['app_name'] = settings.APP_NAME
         return o
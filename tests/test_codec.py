@@ -0,0 +1,40 @@
+import decimal
+import json
+import unittest
+import uuid
+
+import django
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure()
+    django.setup()
+
+from django_chilies import codec  # noqa: E402
+from django_chilies.common import DefaultJSONEncoder  # noqa: E402
+from django_chilies.utils import JSONRenderer, json_text  # noqa: E402
+
+
+class CodecTestCase(unittest.TestCase):
+
+    def test_wide_ints(self):
+        o = {'big': 2 ** 70, 'neg': -2 ** 65, 'max': 2 ** 64 - 1}
+        self.assertEqual(codec.loads(codec.dumpb(o)), o)
+        self.assertEqual(codec.loads(codec.dumps(o)), o)
+
+    def test_same_output_as_stdlib(self):
+        o = {'uuid': uuid.UUID(int=1), 'decimal': decimal.Decimal('1.5'), 'text': '中文'}
+        self.assertEqual(codec.dumpb(o), codec._dumps(o, None, True).encode('utf-8'))
+        self.assertIn(b'"uuid":"00000000-0000-0000-0000-000000000001"', codec.dumpb(o))
+
+    def test_json_text(self):
+        o = {'a': [1, '中文']}
+        self.assertEqual(json_text(o), json.dumps(o, ensure_ascii=False, cls=DefaultJSONEncoder))
+
+    def test_renderer_strict_json(self):
+        with self.assertRaises(ValueError):
+            JSONRenderer().render({'a': float('nan')})
+
+
+if __name__ == '__main__':
+    unittest.main()
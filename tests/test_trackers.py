@@ -0,0 +1,89 @@
+import logging
+import unittest
+
+import django
+from django.conf import settings
+from django.test import override_settings
+
+if not settings.configured:
+    settings.configure()
+    django.setup()
+
+from django_chilies import metrics  # noqa: E402
+from django_chilies.trackers import HTTPTracker, Logger, TaskTracker  # noqa: E402
+from django_chilies.writers import Writer  # noqa: E402
+
+
+class CaptureWriter(Writer):
+
+    def __init__(self):
+        super().__init__(name='capture', level='DEBUG')
+        self.messages = []
+
+    def write(self, o):
+        self.messages.append(o)
+
+
+class HTTPTrackerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.override = override_settings(DJANGO_CHILIES={'TRACKER': {'retention': {'enabled': True}}})
+        self.override.enable()
+        self.tracker = HTTPTracker('http')
+        self.tracker.context['http']['url_name'] = 'book-list'
+        logging.disable(logging.CRITICAL)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+        self.override.disable()
+
+    def test_api_result_keeps_warning_level(self):
+        self.tracker.warn('careful')
+        self.tracker.set_api_result({'code': 200, 'message': 'Success'})
+        self.assertEqual(self.tracker.context['level'], logging.WARN)
+        self.assertTrue(self.tracker.is_retained(200, 1))
+
+    def test_api_result_level(self):
+        self.tracker.set_api_result({'code': 500, 'message': 'Internal Server Error'})
+        self.assertEqual(self.tracker.context['level'], logging.ERROR)
+        self.assertTrue(self.tracker.is_retained(200, 1))
+
+    def test_api_result_without_code(self):
+        self.tracker.set_api_result({'message': 'Success'})
+        self.assertIsNone(self.tracker.context['api']['code'])
+        self.assertEqual(self.tracker.context['level'], logging.INFO)
+        self.assertFalse(self.tracker.is_retained(200, 1))
+
+
+class LoggerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def test_mapping_args(self):
+        logger = Logger(buffer_size=10, capture_caller=False)
+        logger.info('%(a)s-%(b)s', {'a': 1, 'b': 2})
+        logger.info('%s', {})
+        self.assertEqual([line.rsplit('] ', 1)[1] for line in logger.flush().splitlines()], ['1-2', '{}'])
+
+    def test_dropped_lines_counted_after_flush(self):
+        writer = CaptureWriter()
+        tracker = TaskTracker('dropped-lines', writers=[writer], buffer_size=100, buffer_bytes=2000,
+                              capture_caller=False)
+        for i in range(60):
+            # 估算的长度小于格式化后的长度, flush时继续丢弃
+            tracker.info('%s', 10 ** 60)
+        tracker.persistent()
+        message = writer.messages[-1]
+        notice = message['message'].splitlines()[-1]
+        self.assertEqual(notice, '... %s lines dropped ...' % message['dropped_lines'])
+        self.assertEqual(metrics.tracker_metrics('dropped-lines').counters['dropped_lines'],
+                         message['dropped_lines'])
+        self.assertEqual(tracker.session.dropped_lines, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import datetime
+import decimal
+import json
+import unittest
+import uuid
+from collections import OrderedDict
+
+import django
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure()
+    django.setup()
+
+from django_chilies.common import DefaultJSONEncoder  # noqa: E402
+from django_chilies.utils import snapshot  # noqa: E402
+
+
+class SnapshotTestCase(unittest.TestCase):
+
+    def test_round_trip(self):
+        o = {'a': (1, 2.5, None), 1: [True, {'b': 'c'}]}
+        self.assertEqual(snapshot(o), {'a': [1, 2.5, None], '1': [True, {'b': 'c'}]})
+        self.assertEqual(snapshot(o, max_items=10), snapshot(o))
+
+    def test_same_as_stdlib_round_trip(self):
+        o = {
+            'big': 2 ** 70, 'uuid': uuid.UUID(int=1), 'decimal': decimal.Decimal('1.5'), 'nan': float('nan'),
+            'time': datetime.datetime(2020, 1, 2, 3, 4, 5), 'set': {1}, 'bytes': b'x',
+            'ordered': OrderedDict([(2, 'b'), ('a', [datetime.date(2020, 1, 1)])]),
+        }
+        expected = json.loads(json.dumps(o, cls=DefaultJSONEncoder))
+        self.assertEqual(json.dumps(snapshot(o)), json.dumps(expected))
+        self.assertIs(type(snapshot(o)['big']), int)
+        self.assertEqual(snapshot(o)['uuid'], '00000000-0000-0000-0000-000000000001')
+
+    def test_size_exhausted_by_key(self):
+        o = {'k' * 20: 'x' * 100000}
+        self.assertEqual(snapshot(o, max_size=10), {'k' * 20: '...(truncated: 100000 chars)'})
+
+    def test_max_items(self):
+        self.assertEqual(snapshot(list(range(5)), max_items=2), [0, 1, '...(3 more items)'])
+
+    def test_max_depth(self):
+        self.assertEqual(snapshot({'a': {'b': {}}}, max_depth=1), {'a': '...(truncated: depth > 1)'})
+
+    def test_deep_and_shared(self):
+        deep = node = []
+        for _ in range(250):
+            node.append([])
+            node = node[0]
+        shared = [1]
+        o = {'deep': deep, 'a': shared, 'b': shared}
+        self.assertEqual(snapshot(o), o)
+        self.assertEqual(snapshot(o, max_items=10), o)
+
+    def test_circular_reference(self):
+        o = {}
+        o['o'] = [o]
+        for kwargs in ({}, {'max_items': 10}):
+            with self.assertRaisesRegex(ValueError, 'Circular reference'):
+                snapshot(o, **kwargs)
+
+
+if __name__ == '__main__':
+    unittest.main()
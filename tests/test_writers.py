@@ -0,0 +1,403 @@
+import functools
+import gc
+import logging
+import os
+import tempfile
+import time
+import unittest
+import weakref
+
+import django
+from django.conf import settings
+from django.test import override_settings
+
+if not settings.configured:
+    settings.configure()
+    django.setup()
+
+from django_chilies import utils, writers  # noqa: E402
+from django_chilies.writers import (  # noqa: E402
+    CircuitBreakerWriter, FileWriter, KafkaWriter, Payload, SpoolWriter, SystemWriter, Writer, WriterUnavailable
+)
+
+
+class FakeFuture(object):
+
+    def __init__(self):
+        self.callbacks = []
+        self.errbacks = []
+
+    # 与kafka的Future一致, 额外的参数在结果之前传入
+    def add_callback(self, fn, *args):
+        self.callbacks.append(functools.partial(fn, *args))
+
+    def add_errback(self, fn, *args):
+        self.errbacks.append(functools.partial(fn, *args))
+
+    def succeed(self):
+        for fn in self.callbacks:
+            fn('metadata')
+
+    def fail(self, e=None):
+        for fn in self.errbacks:
+            fn(e or Exception('delivery failed'))
+
+
+class FakeProducer(object):
+    """
+    记录send/flush/close调用, 投递结果由测试通过future控制
+    """
+
+    def __init__(self, **config):
+        self.config = config
+        self.sent = []
+        self.futures = []
+        self.flushed = []
+        self.closed = False
+
+    def send(self, topic, value=None, key=None):
+        self.sent.append((topic, value, key))
+        future = FakeFuture()
+        self.futures.append(future)
+        return future
+
+    def flush(self, timeout=None):
+        self.flushed.append(timeout)
+        if getattr(self, 'flush_error', None):
+            raise self.flush_error
+
+    def close(self, timeout=None):
+        self.closed = True
+
+
+class KafkaWriterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        KafkaWriter.reset_producers()
+
+    def tearDown(self):
+        KafkaWriter.reset_producers()
+
+    def make_writer(self, **kwargs):
+        kwargs.setdefault('level', 'DEBUG')
+        return KafkaWriter(name='kafka-test', topic='tracker', producer={'linger_ms': 5},
+                           producer_class=FakeProducer, **kwargs)
+
+    def test_producer_config(self):
+        writer = self.make_writer(batch_size=1024, compression_type='gzip')
+        self.assertEqual(writer.producer.config, {'linger_ms': 5, 'batch_size': 1024, 'compression_type': 'gzip'})
+
+    def test_message_key(self):
+        writer = self.make_writer()
+        writer.write_payload(Payload({'trace_id': 'abc', 'level': 'INFO'}))
+        writer.write({'trace_id': 123, 'level': 'INFO'})
+        writer.write({'level': 'INFO'})
+        writer.write(b'{}')
+        keys = [key for _, _, key in writer.producer.sent]
+        self.assertEqual(keys, [b'abc', b'123', None, None])
+        self.assertEqual(writer.producer.sent[0][:2], ('tracker', b'{"trace_id":"abc","level":"INFO"}'))
+
+    def test_level_filter(self):
+        writer = self.make_writer(level='ERROR')
+        writer.write_payload(Payload({'trace_id': 'abc', 'level': 'INFO'}))
+        self.assertEqual(writer.producer.sent, [])
+
+    def test_delivery_callbacks(self):
+        writer = self.make_writer()
+        for _ in range(3):
+            writer.write(b'{}')
+        futures = writer.producer.futures
+        futures[0].succeed()
+        futures[1].fail()
+        self.assertEqual(writer.counters['sent'], 3)
+        self.assertEqual(writer.counters['delivered'], 1)
+        self.assertEqual(writer.counters['failed'], 1)
+        self.assertEqual(writer.in_flight, 1)
+
+    def test_in_flight_limit(self):
+        writer = self.make_writer(max_in_flight=2)
+        for _ in range(3):
+            writer.write(b'{}')
+        self.assertEqual(len(writer.producer.sent), 2)
+        self.assertEqual(writer.counters['dropped'], 1)
+        # 确认后释放名额
+        writer.producer.futures[0].succeed()
+        writer.write(b'{}')
+        self.assertEqual(len(writer.producer.sent), 3)
+        writer.producer.futures[1].fail()
+        writer.write(b'{}')
+        self.assertEqual(len(writer.producer.sent), 4)
+
+    def test_send_error_releases_in_flight(self):
+        writer = self.make_writer(max_in_flight=1)
+
+        def send(*args, **kwargs):
+            raise ValueError('too large')
+
+        writer.producer.send = send
+        with self.assertRaises(ValueError):
+            writer.write(b'{}')
+        self.assertEqual(writer.counters['failed'], 1)
+        self.assertTrue(writer._in_flight.acquire(blocking=False))
+
+    def test_flush(self):
+        writer = self.make_writer(flush_timeout=3)
+        writer.flush()
+        self.assertEqual(writer.producer.flushed, [])
+        writer.flush(timeout=1)
+        self.assertEqual(writer.producer.flushed, [1])
+        writer.close()
+        self.assertEqual(writer.producer.flushed, [1, 3])
+
+    def test_sync_flush(self):
+        writer = self.make_writer(sync=True, flush_timeout=2)
+        writer.write(b'{}')
+        writer.flush()
+        self.assertEqual(writer.producer.flushed, [2])
+
+    def test_close_producers(self):
+        writer = self.make_writer()
+        producer = writer.producer
+        KafkaWriter.close_producers(timeout=1)
+        self.assertEqual(producer.flushed, [1])
+        self.assertTrue(producer.closed)
+        # 关闭后重新创建producer
+        self.assertIsNot(writer.producer, producer)
+
+    def test_delivery_failure_marks_unavailable(self):
+        writer = self.make_writer(retry_interval=60)
+        failed = []
+        writer.set_failure_handler(failed.append)
+        writer.write(b'{"a":1}')
+        self.assertTrue(writer.is_available())
+        writer.producer.futures[0].fail()
+        self.assertFalse(writer.is_available())
+        self.assertEqual(failed, [b'{"a":1}'])
+        # 退避结束后恢复, 投递成功后重置退避
+        writer._unavailable_until = 0
+        self.assertTrue(writer.is_available())
+        writer.write(b'{}')
+        writer.producer.futures[1].succeed()
+        self.assertEqual(writer._delivery_failures, 0)
+
+    def test_wait_delivered(self):
+        from kafka.errors import KafkaTimeoutError
+        writer = self.make_writer()
+        self.assertTrue(writer.wait_delivered(1))
+        writer.producer.flush_error = KafkaTimeoutError()
+        self.assertFalse(writer.wait_delivered(1))
+
+
+class MemoryWriter(Writer):
+    accepts = 'bytes'
+
+    def __init__(self):
+        super().__init__(name='memory', level='DEBUG')
+        self.written = []
+        self.available = True
+        self.failures = 0
+        self.delivered = True
+        self.failure_handler = None
+
+    def set_failure_handler(self, handler):
+        self.failure_handler = handler
+
+    def write(self, o):
+        self.written.append(o)
+
+    def flush(self):
+        pass
+
+    def is_available(self):
+        return self.available
+
+    def delivery_failures(self):
+        return self.failures
+
+    def wait_delivered(self, timeout=None):
+        return self.delivered
+
+
+class CircuitBreakerWriterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.inner = MemoryWriter()
+        self.inner.write = self.fail
+        self.writer = CircuitBreakerWriter(self.inner, latency_budget=0, min_calls=2, window=2, open_seconds=0)
+        for _ in range(2):
+            with self.assertRaises(WriterUnavailable):
+                self.writer.write(b'x')
+        self.assertEqual(self.writer.state, CircuitBreakerWriter.OPEN)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def fail(self, o):
+        raise IOError('sink down')
+
+    def test_flush_is_not_a_probe(self):
+        with self.assertRaises(WriterUnavailable):
+            self.writer.flush()
+        self.assertEqual(self.writer.state, CircuitBreakerWriter.OPEN)
+
+    def test_write_probe(self):
+        del self.inner.write
+        self.writer.write(b'x')
+        self.assertEqual(self.writer.state, CircuitBreakerWriter.CLOSED)
+        self.writer.flush()
+        self.assertEqual(self.inner.written, [b'x'])
+
+
+class SpoolWriterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.inner = MemoryWriter()
+        self.writer = SpoolWriter(self.inner, self.directory, check_interval=3600)
+
+    def spool(self, *items):
+        self.inner.available = False
+        for item in items:
+            self.writer.write(item)
+        self.writer.close()
+        self.inner.available = True
+
+    def files(self):
+        return sorted(os.listdir(self.directory))
+
+    def test_replay(self):
+        self.spool(b'1', b'2')
+        self.writer._replay_all()
+        self.assertEqual(self.inner.written, [b'1', b'2'])
+        self.assertEqual(self.files(), [])
+
+    def test_keep_segment_until_delivered(self):
+        self.spool(b'1', b'2')
+        self.inner.delivered = False
+        self.writer._replay_all()
+        self.assertEqual(len(self.files()), 1)
+        self.assertTrue(self.files()[0].endswith(SpoolWriter.READY))
+        # 回放期间有异步投递失败
+        self.inner.delivered = True
+        self.inner.failures = 0
+        write = self.inner.write
+
+        def failing_write(o):
+            write(o)
+            self.inner.failures += 1
+
+        self.inner.write = failing_write
+        self.writer._replay_all()
+        self.assertEqual(len(self.files()), 1)
+        self.inner.write = write
+        self.writer._replay_all()
+        self.assertEqual(self.files(), [])
+
+    def test_failure_handler_spools(self):
+        self.inner.failure_handler(b'late failure')
+        self.writer.close()
+        self.assertEqual(len(self.files()), 1)
+
+    def test_replay_leftover_on_start(self):
+        self.spool(b'1', b'2')
+        inner = MemoryWriter()
+        SpoolWriter(inner, self.directory, check_interval=0.01)
+        deadline = time.monotonic() + 5
+        while self.files() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(inner.written, [b'1', b'2'])
+        self.assertEqual(self.files(), [])
+
+    def test_leftover_tmp(self):
+        dead_pid = 2 ** 22 + 1
+        name = 'memory.%020d.1%s%s' % (time.time_ns(), SpoolWriter.REPLAYING, dead_pid)
+        with open(os.path.join(self.directory, name), 'wb') as f:
+            f.write(b'1\n2\n')
+        with open(os.path.join(self.directory, name + '.tmp'), 'wb') as f:
+            f.write(b'2\n')
+        self.writer._replay_all()
+        self.assertEqual(self.inner.written, [b'1', b'2'])
+        self.assertEqual(self.files(), [])
+
+
+class FileWriterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def read(self):
+        lines = []
+        for name in sorted(os.listdir(self.directory)):
+            with open(os.path.join(self.directory, name), 'rb') as f:
+                lines.extend(f.read().splitlines())
+        return lines
+
+    def test_timed_flush(self):
+        writer = FileWriter('file', directory=self.directory, flush_interval=0.05)
+        writer.write(b'1')
+        writer.flush()
+        self.assertEqual(self.read(), [])
+        time.sleep(0.3)
+        self.assertEqual(self.read(), [b'1'])
+        writer.close()
+
+    def test_rotate_in_same_second(self):
+        writer = FileWriter('file', directory=self.directory, max_bytes=1, compress=False, flush_interval=0)
+        for i in range(3):
+            writer.write(str(i).encode())
+        writer.close()
+        self.assertEqual(len(os.listdir(self.directory)), 3)
+        self.assertEqual(sorted(self.read()), [b'0', b'1', b'2'])
+
+
+class RegistryTestCase(unittest.TestCase):
+
+    def writer_settings(self, directory):
+        return override_settings(DJANGO_CHILIES={'TRACKER': {'writers': {'file': {
+            'class': 'django_chilies.writers.FileWriter', 'directory': directory, 'flush_interval': 0,
+            'async': {'flush_interval': 0.01},
+        }}}})
+
+    def hooked(self, obj):
+        return [ref for ref in utils._exit_funcs + utils._fork_funcs if getattr(ref(), '__self__', None) is obj]
+
+    def test_release_replaced_writer(self):
+        directory = tempfile.mkdtemp()
+        with self.writer_settings(directory):
+            old = writers.instance_from_settings('file')
+            self.assertTrue(self.hooked(old) and self.hooked(old.writer))
+            old.write(b'1')
+        with self.writer_settings(tempfile.mkdtemp()):
+            self.assertIsNot(writers.instance_from_settings('file'), old)
+        # 替换时已关闭并刷出, 不再由退出回调持有
+        self.assertFalse(self.hooked(old) or self.hooked(old.writer))
+        self.assertFalse(old._thread.is_alive())
+        [name] = os.listdir(directory)
+        with open(os.path.join(directory, name), 'rb') as f:
+            self.assertEqual(f.read(), b'1\n')
+
+    def test_hooks_do_not_keep_writer_alive(self):
+        writer = FileWriter('file', directory=tempfile.mkdtemp(), flush_interval=0)
+        ref = weakref.ref(writer)
+        del writer
+        gc.collect()
+        self.assertIsNone(ref())
+
+
+class SystemWriterTestCase(unittest.TestCase):
+
+    def test_timed_flush(self):
+        r, w = os.pipe()
+        os.set_blocking(r, False)
+        writer = SystemWriter('system', format=SystemWriter.NDJSON, flush_interval=0.05)
+        with os.fdopen(w, 'w') as stream, os.fdopen(r, 'rb') as out:
+            writer._write_line(stream, b'1')
+            writer.flush()
+            self.assertIsNone(out.read())
+            time.sleep(0.3)
+            self.assertEqual(out.read(), b'1\n')
+
+
+if __name__ == '__main__':
+    unittest.main()